@@ -1,14 +1,29 @@
 import argparse
+import asyncio
 import configparser
 import http.client
+import inspect
 import json
+import keyword
 import os
+import queue
 import socket
+import struct
+import tempfile
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from urllib.parse import quote
 import random
+import select
+
+try:
+    import lz4.frame as lz4_frame  # 可选依赖，安装后作为更快的压缩编解码器
+except ImportError:
+    lz4_frame = None
 
 
 # 负载均衡模块
@@ -64,9 +79,16 @@ class RegistryClient:
     def __init__(self, logger):
         """
         成员变量解释
-        self.registry_host : string 配置文件中读入的注册中心的 IP
-        self.registry_port : int 配置文件中读入的注册中心的端口号
+        self.registry_endpoints : list 配置文件中读入的注册中心节点 (host, port) 列表，集群模式下有多个
         self.servers_cache = set() 本地缓存的服务端列表
+        self.servers_params = {} 本地缓存的各服务端注册时附带的参数，(host, port) -> parameters
+        self.method_index = {} 由各服务端发布的方法表建立的方法名 -> 服务端集合索引
+        self.unindexed_servers = set() 未发布方法表（旧版本）的服务端，无法判断是否提供某方法，按方法选服务端时总是计入
+        self.idempotent_methods = set() 服务端方法表中标记为幂等的方法名，只有这些方法可以对冲
+        self.cache_file : string 服务端列表落盘文件，启动时先加载它，注册中心慢或不可用时也能立即发起调用
+        self.stale_after : int 服务端列表距上次从注册中心成功获取超过这么多秒即视为过期
+        self.lock : 轮询线程与调用线程都会更新服务端列表、参数与方法索引，更新时持锁并整体替换，
+                    读取方拿到的始终是完整的旧值或新值，不会遍历到正在被修改的容器
         :param logger: 运行日志
         """
         self.logger = logger
@@ -75,43 +97,456 @@ class RegistryClient:
         try:
             config.read('docket_test_config.ini')  # docker
             # config.read('../config.ini')  # local
-            self.registry_host = config['registry']['host']
-            self.registry_port = int(config['registry']['port'])
+            self.registry_endpoints = self.parse_registry_endpoints(config['registry'])
+            self.cache_file = config.get('client', 'cache_file', fallback='rpc_servers_cache.json')
+            self.stale_after = config.getint('client', 'stale_after', fallback=300)
         except Exception as e:
             self.logger.error(f"Error occurred in reading registry config:{e}")
             exit(-1)
 
+        self.preferred_index = 0
+        self.read_index = 0  # 服务发现请求轮流从不同节点开始，分散注册中心的读压力
+        self.endpoint_down_until = {}  # 节点下标 -> 在此时间前视为不可达
+        self.lock = threading.Lock()
         self.servers_cache = set()
-        self.logger.info(f"成功从配置文件读取到注册中心ip地址: {self.registry_host}:{self.registry_port}"
+        self.servers_params = {}
+        self.method_index = {}
+        self.unindexed_servers = set()
+        self.idempotent_methods = set()
+        self.revision = None  # 当前服务端列表对应的注册中心修订号
+        self.refreshed_at = 0  # 当前服务端列表从注册中心获取的时间（time.time()）
+        self.logger.info(f"成功从配置文件读取到注册中心ip地址: "
+                         f"{', '.join(f'{h}:{p}' for h, p in self.registry_endpoints)}"
                          f"\n=========================================================================================")
+        self.load_cache()
+
+    def load_cache(self, protocol="json"):
+        """启动时加载上次落盘的服务端列表，之后由轮询线程在后台刷新"""
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.error(f"读取服务端列表缓存文件 {self.cache_file} 失败：{e}")
+            return
+        try:
+            if cache.get('protocol') != protocol:
+                return
+            with self.lock:
+                self.servers_cache = {(ins['host'], ins['port']) for ins in cache['servers'] if self.is_usable(ins)}
+                self.servers_params = {(ins['host'], ins['port']): ins.get('parameters') or {}
+                                       for ins in cache['servers']}
+                self.index_methods()
+            self.revision = cache.get('revision')
+            self.refreshed_at = float(cache.get('saved_at', 0))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            # json 格式正确但结构不对（手工编辑、其他程序写入的同名文件），视为没有缓存
+            self.logger.error(f"服务端列表缓存文件 {self.cache_file} 结构无效，忽略：{e!r}")
+            with self.lock:
+                self.servers_cache, self.servers_params = set(), {}
+                self.index_methods()
+            self.revision, self.refreshed_at = None, 0
+            return
+        self.logger.info(f"从缓存文件加载了 {len(self.servers_cache)} 个服务端（修订号 {self.revision}，"
+                         f"{time.time() - self.refreshed_at:.0f} 秒前获取{'，已过期' if self.is_stale() else ''}）")
+
+    def save_cache(self, servers_raw, protocol="json"):
+        """
+        把最近一次成功获取的服务端列表连同修订号落盘，先写临时文件再原子替换，避免进程中途退出留下半个文件；
+        临时文件名唯一，同一目录下的多个客户端进程不会写坏彼此的临时文件
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_file)),
+                                            prefix=os.path.basename(self.cache_file) + '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'protocol': protocol, 'revision': self.revision, 'saved_at': self.refreshed_at,
+                           'servers': servers_raw}, f)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            self.logger.error(f"写入服务端列表缓存文件 {self.cache_file} 失败：{e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def is_usable(ins):
+        """
+        服务端是否可供选择：正在排空（即将退出）的服务端不再被选择，其已在处理的请求仍会完成；
+        只监听 Unix 域 socket 的服务端只有同一台机器上的客户端能连上
+        """
+        params = ins.get('parameters') or {}
+        if params.get('draining'):
+            return False
+        if ins['host'].startswith('unix:') and params.get('hostname') != socket.gethostname():
+            return False
+        return True
+
+    def index_methods(self):
+        """持锁调用：服务端参数更新后重建方法索引，按方法选服务端时只需查表，不必逐个扫描各服务端的方法表"""
+        method_index = defaultdict(set)
+        unindexed_servers = set()
+        idempotent_methods = set()
+        for server, params in self.servers_params.items():
+            if 'methods' not in params:
+                unindexed_servers.add(server)
+                continue
+            for method in params['methods']:
+                method_index[method['method_name']].add(server)
+                if method.get('idempotent'):
+                    idempotent_methods.add(method['method_name'])
+        self.method_index, self.unindexed_servers = dict(method_index), unindexed_servers
+        self.idempotent_methods = idempotent_methods
+
+    def is_idempotent(self, method_name):
+        """方法是否被服务端标记为幂等（重复执行无副作用），只有幂等方法才能安全地对冲"""
+        return method_name in self.idempotent_methods
+
+    def servers_for_method(self, method_name):
+        """
+        从本地服务端列表中选出提供该方法的服务端（未发布方法表的服务端也计入）
+        :return: (host, port) 的元组 list，本地没有提供该方法的服务端时返回空列表
+        """
+        with self.lock:
+            candidates = self.method_index.get(method_name, set()) | self.unindexed_servers
+            return [server for server in candidates if server in self.servers_cache]
+
+    def findRpcServersByMethod(self, method_name, protocol="json"):
+        """
+        本地服务端列表中没有提供该方法的服务端时（如刚上线的服务端尚未轮询到），直接向注册中心按方法查询，
+        查到的服务端并入本地列表
+        :return: (host, port) 的元组 list
+        """
+        try:
+            status, data, _ = self.request_registry(
+                "GET", f"/myRegistry/findInstancesByMethod?proto={protocol}&method={quote(method_name)}", spread=True)
+        except (OSError, http.client.HTTPException) as e:
+            self.logger.error(f'按方法 {method_name} 查询注册中心失败：{e}')
+            return []
+        if status != 200:
+            return []
+        found = {(ins['host'], ins['port']): ins.get('parameters') or {}
+                 for ins in json.loads(data.decode()) if self.is_usable(ins)}
+        if found:
+            with self.lock:
+                servers_params = dict(self.servers_params)
+                servers_params.update(found)
+                self.servers_params = servers_params
+                self.servers_cache = self.servers_cache | set(found)
+                self.index_methods()
+        return list(found)
+
+    def discard_server(self, server):
+        """连接失败的服务端移出本地列表，直到下次轮询注册中心时重新加入"""
+        with self.lock:
+            self.servers_cache = self.servers_cache - {server}
+
+    def is_stale(self):
+        """本地服务端列表是否已经过期（太久没有从注册中心成功刷新）"""
+        return time.time() - self.refreshed_at > self.stale_after
+
+    @staticmethod
+    def parse_registry_endpoints(registry_config):
+        """
+        读取注册中心节点列表：集群模式下配置 hosts = host:port,host:port，否则使用单节点的 host 与 port
+        :return: (host, port) 元组 list
+        """
+        if registry_config.get('hosts'):
+            endpoints = []
+            for endpoint in registry_config['hosts'].split(','):
+                endpoint_host, endpoint_port = endpoint.strip().rsplit(':', 1)
+                endpoints.append((endpoint_host.strip('[]'), int(endpoint_port)))
+            return endpoints
+        return [(registry_config['host'], int(registry_config['port']))]
+
+    def request_registry(self, method, url, body=None, headers=None, spread=False):
+        """
+        向注册中心发送 HTTP 请求，失败时依次故障转移到其余节点
+        :param spread: bool 为 True 时每次从下一个节点开始尝试，把读请求分散到各节点；
+                       否则固定从上次成功的节点开始，写请求（注册、心跳）尽量落在同一节点
+        :return: (status, response_body, response_headers)
+        """
+        count = len(self.registry_endpoints)
+        if spread:
+            self.read_index = (self.read_index + 1) % count
+            start = self.read_index
+        else:
+            start = self.preferred_index
+        # 最近失败过的节点排到最后再试，避免每次都先在不可达节点上等待超时
+        now = time.monotonic()
+        order = sorted(((start + i) % count for i in range(count)),
+                       key=lambda index: self.endpoint_down_until.get(index, 0) > now)
+        last_error = None
+        for index in order:
+            host, port = self.registry_endpoints[index]
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            try:
+                conn.request(method, url, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+                if not spread and index != self.preferred_index:
+                    self.logger.info(f"注册中心故障转移到 {host}:{port}")
+                    self.preferred_index = index
+                self.endpoint_down_until.pop(index, None)
+                return response.status, data, response.headers
+            except (OSError, http.client.HTTPException) as e:
+                self.logger.error(f"与注册中心 {host}:{port} 通信时发生错误：{e}")
+                self.endpoint_down_until[index] = time.monotonic() + 30
+                last_error = e
+            finally:
+                conn.close()
+        raise last_error
 
     def findRpcServers(self, protocol="json"):
         """
-        http与注册中心通信，返回 (host, port) 的元组 list
+        http与注册中心通信，返回 (host, port) 的元组 list；注册中心不可用时返回本地缓存（可能已过期）的服务端列表
         :return: tuple list
         """
-        conn = http.client.HTTPConnection(self.registry_host, self.registry_port)
         try:
-            conn.request("GET", f"/myRegistry/findAllInstances?proto={protocol}")
-            response = conn.getresponse()
-            if response.status == 200:
-                data = response.read().decode()
-                servers_raw = json.loads(data)
+            status, data, headers = self.request_registry("GET", f"/myRegistry/findAllInstances?proto={protocol}",
+                                                          spread=True)
+            if status == 200:
+                servers_raw = json.loads(data.decode())
                 tmp_server_set = set()
+                tmp_params = {}
                 for ins in servers_raw:
-                    tmp_server_set.add((ins['host'], ins['port']))
-                origin_set = self.servers_cache.copy()
-                self.servers_cache = self.servers_cache.union(tmp_server_set)
-                self.servers_cache -= origin_set - tmp_server_set
-                servers = list(self.servers_cache)
+                    tmp_params[(ins['host'], ins['port'])] = ins.get('parameters') or {}
+                    if self.is_usable(ins):
+                        tmp_server_set.add((ins['host'], ins['port']))
+                # 各注册中心节点的修订号是节点本地的计数器，读请求又轮流发往不同节点，修订号不能用来判断列表是否变化，
+                # 直接比较实例及其参数；列表有变化时才写盘，轮询时列表不变则不产生磁盘写
+                with self.lock:
+                    changed = tmp_params != self.servers_params
+                    self.servers_params = tmp_params
+                    self.index_methods()
+                    self.servers_cache = tmp_server_set
+                servers = list(tmp_server_set)
+                self.revision = headers.get('X-Registry-Revision')
+                self.refreshed_at = time.time()
+                if changed:
+                    self.save_cache(servers_raw, protocol)
                 return servers  # eg: return [("127.0.0.1", 9999), ("127.0.0.1", 9998)]
             else:
                 return []
-        except (TimeoutError, ConnectionRefusedError) as e:
-            self.logger.error(f'与注册中心通信时发生错误：{e}，获取最新服务端信息失败，使用本地缓存的服务端列表')
-            return []
-        finally:
-            conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            self.logger.error(f'与所有注册中心节点通信均失败：{e}，获取最新服务端信息失败，使用本地缓存的服务端列表'
+                              f'{"（已过期）" if self.is_stale() else ""}')
+            return list(self.servers_cache)
+
+
+class Compression:
+    """
+    帧级压缩编解码器表：编解码器名称用于在注册参数和请求信封中协商，编解码器 id 写入帧头。
+    zlib 为标准库始终可用；安装了 lz4 时优先使用更快的 lz4
+    """
+    CODECS = {'zlib': (1, zlib.compress, zlib.decompress)}  # name -> (codec id, compress, decompress)
+    if lz4_frame is not None:
+        CODECS['lz4'] = (2, lz4_frame.compress, lz4_frame.decompress)
+    PREFERENCE = ('lz4', 'zlib') if lz4_frame is not None else ('zlib',)  # 越靠前越优先
+    DECOMPRESSORS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+    @staticmethod
+    def negotiate(offered):
+        """从对端支持的编解码器列表中选出本端最优先的一个，没有共同支持的返回 None（不压缩）"""
+        if not offered:
+            return None
+        for name in Compression.PREFERENCE:
+            if name in offered:
+                return name
+        return None
+
+
+class Tracer:
+    """
+    分布式追踪：客户端按采样率为调用生成 trace/span id 随请求信封传播，客户端与服务端分别记录各阶段耗时，
+    结束的 span 以 Zipkin v2 JSON 格式（每行一个 span，阶段耗时记在 tags 中，单位微秒）写入本地文件，由后台线程批量落盘
+    """
+
+    def __init__(self, service_name, logger, flush_interval=1.0):
+        """
+        :param service_name: string span 中的服务名，也用作 span 文件名前缀
+        :param logger: 运行日志
+        :param flush_interval: float 后台线程落盘间隔（秒）
+        """
+        self.service_name = service_name
+        self.logger = logger
+        self.flush_interval = flush_interval
+        config = configparser.ConfigParser()
+        config.read('docket_test_config.ini')
+        self.sample_rate = config.getfloat('tracing', 'sample_rate', fallback=0.0)
+        spans_dir = config.get('tracing', 'spans_dir', fallback='traces')
+        self.spans_file = os.path.join(spans_dir, f'{service_name}-{os.getpid()}.jsonl')
+        self.pending = []  # 尚未落盘的 span
+        self.lock = threading.Lock()
+        self.flush_thread = None
+
+    def start_trace(self):
+        """按采样率决定是否追踪本次调用：采样时返回随请求发送的追踪上下文，否则返回 None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return {'trace_id': f'{random.getrandbits(128):032x}', 'span_id': f'{random.getrandbits(64):016x}',
+                'sampled': True}
+
+    def record(self, trace, name, kind, start, duration, stages, remote=None, tags=None, span_id=None,
+               parent_id=None):
+        """
+        记录一个结束的 span
+        :param trace: dict 追踪上下文，提供 trace_id
+        :param kind: string 'CLIENT' / 'SERVER'
+        :param start: float span 开始的时间（time.time()）
+        :param duration: float span 耗时（秒）
+        :param stages: dict 阶段名 -> 耗时（秒）
+        :param remote: (host, port) 对端地址
+        :param tags: dict 其余标签
+        :param span_id: string 为空则使用追踪上下文中的 span_id
+        :param parent_id: string 父 span id
+        """
+        span = {'traceId': trace['trace_id'], 'id': span_id or trace['span_id'], 'name': name, 'kind': kind,
+                'timestamp': int(start * 1e6), 'duration': max(1, int(duration * 1e6)),
+                'localEndpoint': {'serviceName': self.service_name}}
+        if parent_id is not None:
+            span['parentId'] = parent_id
+        if remote is not None and not str(remote[0]).startswith('unix:'):
+            host, port = remote[0], remote[1]
+            span['remoteEndpoint'] = {'ipv6' if ':' in host else 'ipv4': host, 'port': port}
+        span_tags = {f'stage.{stage}_us': str(int(seconds * 1e6)) for stage, seconds in stages.items()}
+        span_tags.update({key: str(value) for key, value in (tags or {}).items()})
+        span['tags'] = span_tags
+        with self.lock:
+            self.pending.append(span)
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(target=self.loop_flush, daemon=True)
+                self.flush_thread.start()
+
+    def loop_flush(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """把积攒的 span 追加写入 span 文件"""
+        with self.lock:
+            spans, self.pending = self.pending, []
+        if not spans:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.spans_file) or '.', exist_ok=True)
+            with open(self.spans_file, 'a') as f:
+                f.write(''.join(json.dumps(span) + '\n' for span in spans))
+        except OSError as e:
+            self.logger.error(f"写入 span 文件 {self.spans_file} 失败：{e}")
+
+
+class CompressionMetrics:
+    """帧压缩统计：分压缩/解压两个方向记录帧数、原始字节数、线上字节数与 CPU 耗时"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {'compress': [0, 0, 0, 0.0], 'decompress': [0, 0, 0, 0.0]}
+
+    def record(self, direction, raw_size, wire_size, cpu_time):
+        with self.lock:
+            stat = self.stats[direction]
+            stat[0] += 1
+            stat[1] += raw_size
+            stat[2] += wire_size
+            stat[3] += cpu_time
+
+    def snapshot(self):
+        """返回各方向的统计，ratio 为原始字节数/线上字节数"""
+        with self.lock:
+            return {direction: {'frames': frames,
+                                'raw_bytes': raw,
+                                'wire_bytes': wire,
+                                'ratio': round(raw / wire, 2) if wire else None,
+                                'cpu_ms': round(cpu * 1000, 3)}
+                    for direction, (frames, raw, wire, cpu) in self.stats.items()}
+
+
+class FrameTooLarge(ValueError):
+    """消息体超过单帧上限，长度头放不下，不能发送"""
+    pass
+
+
+class FrameProtocol:
+    """
+    TCP 消息分帧：每帧为 4 字节大端无符号长度头 + 消息体，需与服务端的 FrameProtocol 保持一致
+    """
+    HEADER = struct.Struct('!I')
+    CODEC_SHIFT = 28  # 长度头高 4 位记录压缩编解码器 id（0 为未压缩），低 28 位为消息体长度
+    LENGTH_MASK = (1 << CODEC_SHIFT) - 1
+    MAX_FRAME_SIZE = 64 * 1024 * 1024  # 单帧上限，防止异常长度头导致一次性申请过大内存
+
+    @staticmethod
+    def pack(payload, codec=None, threshold=0, metrics=None):
+        """
+        打包一帧；指定 codec 且消息体不小于 threshold 时压缩，压缩后反而变大则原样发送
+        :param payload: bytes 消息体
+        :param codec: string 与对端协商出的编解码器名称，None 表示不压缩
+        :param threshold: int 压缩阈值（字节）
+        :param metrics: CompressionMetrics 压缩统计，可为空
+        """
+        codec_id = 0
+        if codec is not None and len(payload) >= threshold:
+            cid, compress, _ = Compression.CODECS[codec]
+            start = time.thread_time()
+            compressed = compress(payload)
+            if metrics is not None:
+                metrics.record('compress', len(payload), min(len(compressed), len(payload)),
+                               time.thread_time() - start)
+            if len(compressed) < len(payload):
+                payload, codec_id = compressed, cid
+        if len(payload) > FrameProtocol.MAX_FRAME_SIZE:
+            # 长度超过低 28 位会溢出到编解码器 id 所在的高 4 位，对端将读错帧边界，只能拒绝发送
+            raise FrameTooLarge(f"frame too large: {len(payload)} bytes, limit {FrameProtocol.MAX_FRAME_SIZE} bytes")
+        return FrameProtocol.HEADER.pack(codec_id << FrameProtocol.CODEC_SHIFT | len(payload)) + payload
+
+    @staticmethod
+    def recv_exact(sock, length):
+        """从 sock 中收满 length 个字节；连接在帧开始前关闭抛 EOFError，帧传输中途关闭抛 ConnectionError"""
+        buf = bytearray()
+        while len(buf) < length:
+            chunk = sock.recv(length - len(buf))
+            if not chunk:
+                if not buf:
+                    raise EOFError()
+                raise ConnectionError("connection closed in the middle of a frame")
+            buf += chunk
+        return bytes(buf)
+
+    @staticmethod
+    def recv(sock, metrics=None):
+        """接收一整帧，返回（必要时解压后的）消息体"""
+        (value,) = FrameProtocol.HEADER.unpack(FrameProtocol.recv_exact(sock, FrameProtocol.HEADER.size))
+        codec_id, length = value >> FrameProtocol.CODEC_SHIFT, value & FrameProtocol.LENGTH_MASK
+        if length > FrameProtocol.MAX_FRAME_SIZE:
+            raise ConnectionError(f"frame too large: {length} bytes")
+        payload = FrameProtocol.recv_exact(sock, length) if length else b''
+        if codec_id:
+            start = time.thread_time()
+            raw = Compression.DECOMPRESSORS[codec_id](payload)
+            if metrics is not None:
+                metrics.record('decompress', len(raw), len(payload), time.thread_time() - start)
+            payload = raw
+        return payload
+
+    @staticmethod
+    def recv_legacy(sock):
+        """接收旧版服务端不分帧的 json 回复：持续读取，直到已收到的字节构成完整的 json 文档"""
+        buf = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                if not buf:
+                    raise EOFError()
+                raise ConnectionError("connection closed in the middle of a legacy reply")
+            buf += chunk
+            try:
+                json.loads(buf)
+                return bytes(buf)
+            except ValueError:
+                if len(buf) > FrameProtocol.MAX_FRAME_SIZE:
+                    raise ConnectionError(f"legacy reply too large: {len(buf)} bytes")
 
 
 class TCPClient:
@@ -119,6 +554,7 @@ class TCPClient:
         self.sock = None
         self.host = host
         self.port = port
+        self.reused = False  # sock 是否为从连接池取出的空闲连接
 
     def connect(self, host=None, port=None):
         """连接SERVER"""
@@ -126,6 +562,7 @@ class TCPClient:
             self.sock.connect((self.host, self.port))
         else:
             self.sock.connect((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def send(self, data):
         """发送数据到SERVER"""
@@ -135,28 +572,484 @@ class TCPClient:
         """接收SERVER回传的数据"""
         return self.sock.recv(length)
 
+    def send_frame(self, payload, codec=None, threshold=0, metrics=None):
+        """按帧格式发送一条消息到SERVER，参数含义同 FrameProtocol.pack"""
+        self.sock.sendall(FrameProtocol.pack(payload, codec, threshold, metrics))
+
+    def recv_frame(self, metrics=None):
+        """接收SERVER回传的一整帧消息"""
+        return FrameProtocol.recv(self.sock, metrics)
+
     def close(self):
         """关闭连接"""
         self.sock.close()
 
 
+class LatencyTracker:
+    """按方法记录最近的调用耗时（到收到第一帧回复为止），用于估计对冲延迟"""
+
+    def __init__(self, window=256, min_samples=20):
+        """
+        :param window: int 每个方法保留的最近样本数
+        :param min_samples: int 样本数不足时不给出分位数估计
+        """
+        self.min_samples = min_samples
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, method, latency):
+        with self.lock:
+            self.samples[method].append(latency)
+
+    def percentile(self, method, q):
+        """
+        :param q: float 分位点，如 0.95
+        :return: float 该方法最近耗时的 q 分位数（秒），样本不足时返回 None
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(method, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class HedgeBudget:
+    """
+    对冲请求预算：每次可对冲的调用存入 ratio 个令牌（最多积攒 burst 个），每发出一个对冲请求取出一个令牌，
+    对冲带来的额外请求因此不超过调用量的 ratio，服务端整体变慢时也不会因对冲而放大负载
+    """
+
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """取出一个令牌，预算不足时返回 False"""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class SingleFlight:
+    """
+    合并相同的并发调用：同一键的调用进行中时，后来的调用不再发出请求，而是等待并共享第一个调用的结果
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # 键 -> 进行中的 Call
+        self.shared = 0  # 共享了他人结果、因而省去的请求数
+
+    def do(self, key, fn, timeout):
+        """
+        :param key: 可哈希的调用键，键相同的调用视为相同
+        :param fn: 无参函数，由第一个调用执行
+        :param timeout: float 等待进行中调用的最长时间（秒），超时抛出 socket.timeout
+        :return: (结果, 是否为共享的结果)
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                call.result = fn()
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result, False
+        if not call.done.wait(timeout):
+            raise socket.timeout("deadline exceeded while waiting for the coalesced call")
+        return call.result, True
+
+
+class ConnectionPool:
+    """
+    按服务端缓存空闲连接：服务端在同一连接上循环处理请求，调用结束后连接放回池中供下次复用，省去每次调用的建连握手；
+    取出时丢弃已被服务端关闭的连接（服务端重启或排空时会关闭空闲连接）
+    """
+
+    def __init__(self, max_idle=8):
+        """
+        :param max_idle: int 每个服务端最多缓存的空闲连接数，多出的连接直接关闭
+        """
+        self.max_idle = max_idle
+        self.idle = defaultdict(deque)  # (host, port) -> 空闲的 socket
+        self.lock = threading.Lock()
+
+    def acquire(self, server):
+        """
+        :param server: (host, port)
+        :return: 可用的空闲 socket，没有则返回 None
+        """
+        while True:
+            with self.lock:
+                socks = self.idle.get(server)
+                if not socks:
+                    return None
+                sock = socks.pop()
+            if not self.is_stale(sock):
+                return sock
+            sock.close()
+
+    @staticmethod
+    def is_stale(sock):
+        """空闲连接上不应有可读数据，可读说明服务端已关闭连接（读到 EOF）或连接出错"""
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def release(self, server, sock):
+        """把调用结束、回复已读完的连接放回池中"""
+        with self.lock:
+            socks = self.idle[server]
+            if len(socks) < self.max_idle:
+                socks.append(sock)
+                return
+        sock.close()
+
+    def size(self, server):
+        with self.lock:
+            return len(self.idle.get(server, ()))
+
+    def discard(self, server):
+        """关闭某个服务端的全部空闲连接"""
+        with self.lock:
+            socks = self.idle.pop(server, ())
+        for sock in socks:
+            sock.close()
+
+    def retain(self, servers):
+        """关闭不在 servers 中的服务端（已下线或已不可用）的空闲连接"""
+        with self.lock:
+            gone = [server for server in self.idle if server not in servers]
+            socks = [sock for server in gone for sock in self.idle.pop(server)]
+        for sock in socks:
+            sock.close()
+
+    def close(self):
+        self.retain(())
+
+
+class RPCStreamError(Exception):
+    """流式调用过程中服务端方法出错"""
+    pass
+
+
+class RPCStream:
+    """
+    流式调用（服务端注册方法为生成器）的结果，既是迭代器也是异步迭代器，随服务端逐帧回复逐项产出结果。
+    持有与服务端的连接直到流结束或被 close；每消费完一个窗口的数据项回送一次信用，服务端据此流控，
+    因此服务端和客户端内存占用都只与窗口大小有关，与结果总量无关
+    """
+    _END = object()  # __anext__ 使用的流结束哨兵
+
+    def __init__(self, tcp_client, window, logger, method, metrics=None):
+        """
+        :param tcp_client: TCPClient 已收到 begin 帧的连接，之后由本对象负责关闭
+        :param window: int 服务端在 begin 帧中告知的流控窗口
+        :param logger: 运行日志
+        :param method: string 调用的方法名，运行日志记录需要
+        :param metrics: CompressionMetrics 压缩统计，可为空
+        """
+        self.tcp_client = tcp_client
+        self.metrics = metrics
+        self.window = window
+        self.logger = logger
+        self.method = method
+        self.unacked = 0  # 已消费但尚未回送信用的数据项数
+        self.count = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            if self.unacked == self.window:
+                self.tcp_client.send_frame(json.dumps({"credit": self.window}).encode('utf-8'))
+                self.unacked = 0
+            frame = json.loads(self.tcp_client.recv_frame(self.metrics).decode('utf-8'))
+        except Exception:
+            self.close()
+            raise
+        kind = frame["stream"]
+        if kind == "data":
+            self.unacked += 1
+            self.count += 1
+            return frame["res"]
+        self.close()
+        if kind == "end":
+            self.logger.info(f"Stream of method: {self.method} finished, {self.count} items received")
+            raise StopIteration
+        raise RPCStreamError(frame["res"])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # 阻塞的收帧放到默认线程池中执行，避免阻塞事件循环；StopIteration 不能穿过 Future，需转换
+        item = await asyncio.get_running_loop().run_in_executor(None, next, self, RPCStream._END)
+        if item is RPCStream._END:
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        """关闭连接；流未结束时关闭即表示放弃剩余结果，服务端会随之停止产出"""
+        if not self.closed:
+            self.closed = True
+            self.tcp_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class StubGenerator:
+    """
+    根据服务端方法表生成类型化客户端桩的源代码：每个远程方法按服务端发布的参数种类重建出与服务端一致的签名，
+    参数由 Python 按签名在本地绑定与校验；位置参数（含 *args）按位置、仅限关键字参数（含 **kwargs）按关键字发出，
+    调用直接进入 RPCClient.invoke 并使用预编码的请求信封开头，不经过 __getattr__ 动态代理。
+    有默认值的参数在桩中以私有哨兵 _UNSET 为默认值，调用方没有传的参数不发送，由服务端使用它自己的默认值：
+    服务端修改默认值后已生成的桩无需重新生成，无法 json 序列化的默认值也不影响调用
+    """
+    P = inspect.Parameter
+    KINDS = {kind.name: kind for kind in (P.POSITIONAL_ONLY, P.POSITIONAL_OR_KEYWORD, P.VAR_POSITIONAL,
+                                          P.KEYWORD_ONLY, P.VAR_KEYWORD)}
+    HELPERS = ('_UNSET', '_arguments')  # 生成代码中的模块级名称，参数不能与之同名，否则方法体内会被参数遮蔽
+
+    class Unset:
+        """签名中有默认值参数的默认值占位，渲染到源代码中即为生成代码里的哨兵 _UNSET"""
+
+        def __repr__(self):
+            return '_UNSET'
+
+    UNSET = Unset()
+
+    PRELUDE = (
+        "class _Unset:\n"
+        "    \"\"\"调用方没有传的参数，不发送，由服务端使用自己的默认值\"\"\"\n\n"
+        "    def __repr__(self):\n"
+        "        return '<server default>'\n\n\n"
+        "_UNSET = _Unset()\n\n\n"
+        "def _arguments(names, values, rest, keywords, extra):\n"
+        "    \"\"\"只转发调用方实际传入的参数；某个位置参数没有传时，其后传入的位置参数改按关键字发出\"\"\"\n"
+        "    args, kwargs = [], {}\n"
+        "    skipped = False\n"
+        "    for name, value in zip(names, values):\n"
+        "        if value is _UNSET:\n"
+        "            skipped = True\n"
+        "        elif skipped:\n"
+        "            kwargs[name] = value\n"
+        "        else:\n"
+        "            args.append(value)\n"
+        "    args.extend(rest)\n"
+        "    kwargs.update((name, value) for name, value in keywords.items() if value is not _UNSET)\n"
+        "    kwargs.update(extra)\n"
+        "    return tuple(args), kwargs\n\n\n")
+
+    @staticmethod
+    def signature(method):
+        """
+        :param method: dict 方法信息（all_your_methods 的一项）
+        :return: inspect.Signature 首个参数为 self 的方法签名；无法表示时返回 None：
+                 方法表没有参数种类（旧版本服务端）、方法名或参数名不是合法标识符、参数名与 self 或生成代码中的名称冲突
+        """
+        name = method['method_name']
+        if 'params' not in method or not name.isidentifier() or keyword.iskeyword(name):
+            return None
+        P = StubGenerator.P
+        try:
+            params = [P(param['name'], StubGenerator.KINDS[param['kind']],
+                        default=StubGenerator.UNSET if param.get('has_default') or 'default' in param else P.empty)
+                      for param in method['params']]
+            if any(param.name in StubGenerator.HELPERS for param in params):
+                return None
+            # 服务端有仅限位置参数时 self 也须仅限位置，否则签名顺序不合法
+            self_kind = P.POSITIONAL_ONLY if params and params[0].kind is P.POSITIONAL_ONLY else P.POSITIONAL_OR_KEYWORD
+            return inspect.Signature([P('self', self_kind)] + params)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def call_arguments(signature):
+        """
+        :return: string 传给 invoke 的位置参数元组与关键字参数字典两个实参的源代码，按参数种类把签名中的参数转发给服务端：
+                 没有带默认值的参数时直接写出，否则经 _arguments 在调用时只组装调用方实际传入的参数
+        """
+        P = StubGenerator.P
+        names, keywords = [], []
+        rest = extra = None
+        params = list(signature.parameters.values())[1:]
+        for param in params:
+            if param.kind in (P.POSITIONAL_ONLY, P.POSITIONAL_OR_KEYWORD):
+                names.append(param.name)
+            elif param.kind is P.VAR_POSITIONAL:
+                rest = param.name
+            elif param.kind is P.KEYWORD_ONLY:
+                keywords.append(param.name)
+            else:
+                extra = param.name
+
+        def tuple_source(items):
+            return f"({', '.join(items)}{',' if len(items) == 1 else ''})"
+
+        keyword_items = [f'{name!r}: {name}' for name in keywords]
+        if all(param.default is P.empty for param in params):
+            positional = names + (['*' + rest] if rest else [])
+            return f"{tuple_source(positional)}, {{{', '.join(keyword_items + (['**' + extra] if extra else []))}}}"
+        return (f"*_arguments({tuple_source([repr(name) for name in names])}, {tuple_source(names)}, "
+                f"{rest or '()'}, {{{', '.join(keyword_items)}}}, {extra or '{}'})")
+
+    @staticmethod
+    def generate(methods, class_name='RPCStub'):
+        """
+        :param methods: list 方法信息字典列表
+        :param class_name: string 生成的类名
+        :return: string 桩类的源代码，可写入文件后导入，也可直接 exec
+        """
+        bodies = []
+        names = []
+        for method in sorted(methods, key=lambda m: m['method_name']):
+            signature = StubGenerator.signature(method)
+            if signature is None:
+                continue  # 无法生成与服务端一致签名的方法仍可通过 RPCClient 动态调用
+            name = method['method_name']
+            names.append(name)
+            bodies.append(f"    def {name}{signature}:\n"
+                          f"        return self.invoke({name!r}, {StubGenerator.call_arguments(signature)}, "
+                          f"self.options[{name!r}])\n")
+        header = (f"# 由 RPCClient.stub / client.py --generate-stub 根据服务端方法表生成，请勿手工修改\n\n\n"
+                  f"{StubGenerator.PRELUDE}"
+                  f"class {class_name}:\n"
+                  f"    METHODS = {tuple(names)!r}\n\n"
+                  f"    def __init__(self, client, **options):\n"
+                  f"        \"\"\"\n"
+                  f"        :param client: RPCClient\n"
+                  f"        :param options: 调用选项，同 RPCClient.invoke 的 options（如 timeout、priority）\n"
+                  f"        \"\"\"\n"
+                  f"        self.invoke = client.invoke\n"
+                  f"        self.options = {{name: dict(options, envelope_prefix=client.envelope_prefix(name))\n"
+                  f"                        for name in self.METHODS}}\n")
+        return header + ''.join('\n' + body for body in bodies)
+
+
+class RPCCallProxy:
+    """
+    带调用选项的 RPCClient 调用视图，由 RPCClient.with_timeout 等方法创建，
+    访问的方法名同样动态代理为远程调用，调用时带上本视图的选项
+    """
+
+    def __init__(self, client, **options):
+        self.client = client
+        self.options = options
+
+    def with_timeout(self, timeout):
+        return RPCCallProxy(self.client, **dict(self.options, timeout=timeout))
+
+    def with_priority(self, priority):
+        return RPCCallProxy(self.client, **dict(self.options, priority=priority))
+
+    def with_hedging(self, hedge_delay=None):
+        options = dict(self.options, hedge=True)
+        if hedge_delay is not None:
+            options['hedge_delay'] = hedge_delay
+        return RPCCallProxy(self.client, **options)
+
+    def with_coalescing(self):
+        return RPCCallProxy(self.client, **dict(self.options, coalesce=True))
+
+    def __getattr__(self, method):
+        def _func(*args, **kwargs):
+            return self.client.invoke(method, args, kwargs, self.options)
+
+        return _func
+
+
 class RPCClient:
-    def __init__(self, host=None, port=None):
+    # 每个服务端都提供的保留方法（服务发现、运行指标、剖析管理、健康探测），选服务端时不按方法筛选
+    RESERVED_METHODS = ('all_your_methods', 'your_metrics', 'your_profile_start', 'your_profile_stop', 'your_ping')
+
+    def __init__(self, host=None, port=None, timeout=10, priority='normal', hedging=False, hedge_delay=None,
+                 hedge_budget=0.1, coalescing=False, prefer_unix=True, probe_interval=1.0, prewarm=2, max_idle=8,
+                 framing=True):
         """
         初始化作用：
         根据是否提供 RPCServer host和port判断是否使用注册中心
         如果使用注册中心，启动一个线程定期轮询注册中心。
+        :param timeout: float 默认的单次调用超时时间（秒），可通过 with_timeout 为单次调用单独设置
+        :param priority: string 默认的调用优先级，批处理任务的客户端可设为 'batch'，可通过 with_priority 为单次调用单独设置
+        :param hedging: bool 是否默认对冲调用幂等方法（仅注册中心模式），可通过 with_hedging 为单次调用开启
+        :param hedge_delay: float 对冲延迟（秒），为空则使用各方法最近耗时的 p95
+        :param hedge_budget: float 对冲请求最多占可对冲调用量的比例
+        :param coalescing: bool 是否默认合并幂等方法的相同并发调用（仅注册中心模式），可通过 with_coalescing 为单次调用开启
+        :param prefer_unix: bool 同机服务端声明了 Unix 域 socket 时是否优先通过它调用（仅注册中心模式）；
+                            直连模式下 host 可直接写为 'unix:/path'
+        :param probe_interval: float 健康探测间隔（秒，仅注册中心模式），每个间隔向每个服务端发送一次 your_ping，
+                               超过半个间隔未回复即标记为不健康、不再被选中，直到探测再次成功；为空则不探测
+        :param prewarm: int 探测到新服务端时预先建立的连接数，放入连接池供真实调用直接使用
+        :param max_idle: int 连接池中每个服务端最多保留的空闲连接数
+        :param framing: bool 直连模式下服务端是否使用分帧协议，连接旧版服务端时设为 False，按不分帧的 json 格式通信；
+                        注册中心模式下按各服务端注册时是否声明 framing 参数决定
         """
         self.logger = Logger()
         self.host = host
         self.port = port
+        self.timeout = timeout
+        self.priority = priority
+        self.hedging = hedging
+        self.hedge_delay = hedge_delay
+        self.hedge_budget = HedgeBudget(hedge_budget)
+        self.latency_tracker = LatencyTracker()
+        self.coalescing = coalescing
+        self.single_flight = SingleFlight()
+        self.prefer_unix = prefer_unix
+        self.hostname = socket.gethostname()
         self.running = True
-        if host is not None and port is not None:
+        self.compression_metrics = CompressionMetrics()
+        self.tracer = Tracer('rpc-client', self.logger)
+        self.pool = ConnectionPool(max_idle)
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_interval / 2 if probe_interval else None
+        self.prewarm = prewarm
+        self.framing = framing
+        self.probe_rtt = {}  # (host, port) -> 探测往返时间的滑动平均（秒），只包含探测成功过的服务端
+        self.unhealthy = set()  # 最近一次探测失败的服务端
+        self.probed = set()  # 已探测过（并已预建连接）的服务端
+        if host is not None and (port is not None or host.startswith('unix:')):
             self.mode = 0  # no registry
         else:
             self.mode = 1  # with registry
             self.registry_client = RegistryClient(self.logger)
             threading.Thread(target=self.poll_registry).start()
+            if probe_interval:
+                threading.Thread(target=self.loop_probe).start()
 
     def __getattr__(self, method):
         """
@@ -167,43 +1060,407 @@ class RPCClient:
             """
             代理函数，用于调用Server端的方法；
             """
-            try:
-                tcp_client = TCPClient(self.host, self.port)
-                if self.mode == 0:
-                    if '.' in self.host:
-                        addr_type = socket.AF_INET
-                    else:
-                        addr_type = socket.AF_INET6
-                    tcp_client.sock = socket.socket(addr_type, socket.SOCK_STREAM)
-                    tcp_client.sock.settimeout(10)
-                    tcp_client.connect()
-                else:
-                    self.connect_server_by_registry(tcp_client)
+            return self.invoke(method, args, kwargs)
 
-                dic = {'method_name': method, 'method_args': args, 'method_kwargs': kwargs}
-                tcp_client.send(json.dumps(dic).encode('utf-8'))
-                response = tcp_client.recv(1024)
-                result = json.loads(response.decode('utf-8'))["res"]
+        setattr(self, method, _func)
+        return _func
+
+    def with_timeout(self, timeout):
+        """
+        返回带本次调用超时时间的调用视图，如 client.with_timeout(0.2).add(1, 2)
+        :param timeout: float 超时时间（秒），包括连接、等待服务端排队与执行的全部时间，剩余时间随请求发给服务端
+        """
+        return RPCCallProxy(self, timeout=timeout)
 
+    def with_priority(self, priority):
+        """
+        返回带本次调用优先级的调用视图，如 client.with_priority('batch').add(1, 2)
+        :param priority: string 'interactive' / 'normal' / 'batch'，服务端饱和时优先执行高优先级、优先丢弃低优先级请求
+        """
+        return RPCCallProxy(self, priority=priority)
+
+    def with_hedging(self, hedge_delay=None):
+        """
+        返回对冲调用视图，如 client.with_hedging(0.05).hi('a')，只对服务端标记为幂等的方法生效
+        :param hedge_delay: float 对冲延迟（秒），为空则使用构造时指定的对冲延迟，构造时也未指定则使用该方法最近耗时的 p95
+        """
+        return RPCCallProxy(self, hedge=True).with_hedging(hedge_delay)
+
+    def with_coalescing(self):
+        """
+        返回合并调用视图，如 client.with_coalescing().hi('a')：只对服务端标记为幂等的方法生效，
+        同一方法、相同参数的并发调用只发出一个请求，共享其结果
+        """
+        return RPCCallProxy(self, coalesce=True)
+
+    def invoke(self, method, args, kwargs, options=None):
+        """
+        执行一次远程调用
+        :param method: string 方法名
+        :param args: tuple 方法参数
+        :param kwargs: dict 方法关键字参数
+        :param options: dict 调用选项，timeout 为本次调用的超时时间（秒），默认使用 self.timeout；
+                        priority 为本次调用的优先级，默认使用 self.priority；
+                        hedge 为是否对冲，默认使用 self.hedging；hedge_delay 为对冲延迟，默认使用 self.hedge_delay；
+                        coalesce 为是否合并相同的并发调用，默认使用 self.coalescing
+        :return: 调用结果；流式方法返回 RPCStream；调用出错返回 None
+        """
+        options = options or {}
+        if self.mode == 1 and options.get('coalesce', self.coalescing) and self.registry_client.is_idempotent(method):
+            return self.coalesced_invoke(method, args, kwargs, options)
+        deadline = time.monotonic() + options.get('timeout', self.timeout)
+        if self.mode == 1 and options.get('hedge', self.hedging) and self.registry_client.is_idempotent(method):
+            return self.hedged_invoke(method, args, kwargs, options, deadline)
+        tcp_client = TCPClient(self.host, self.port)
+        try:
+            start = time.monotonic()
+            server, reply = self.send_request(tcp_client, method, args, kwargs, options, deadline)
+            self.latency_tracker.record(method, time.monotonic() - start)
+            result = self.handle_reply(tcp_client, server, method, args, kwargs, reply)
+        except socket.timeout as e:
+            self.logger.error(f"Deadline exceeded when calling method {method}: {e}")
+            if tcp_client.sock is not None:
                 tcp_client.close()
+            result = None
+        except Exception as e:
+            self.logger.error(f"Error occurred when calling method {method}: {e}")
+            if tcp_client.sock is not None:
+                tcp_client.close()
+            result = None
+
+        return result
+
+    def coalesced_invoke(self, method, args, kwargs, options):
+        """
+        合并调用：同一方法、相同参数的调用进行中时，后来者等待并共享其结果；
+        结果为流时不能共享（流只能被消费一次），后来者各自发出调用
+        :return: 同 invoke
+        """
+        def call():
+            return self.invoke(method, args, kwargs, dict(options, coalesce=False))
+
+        try:
+            key = (method, json.dumps([args, kwargs], sort_keys=True))
+        except (TypeError, ValueError):
+            return call()  # 参数无法序列化，调用本身也会失败，交由 invoke 记录错误
+        try:
+            result, shared = self.single_flight.do(key, call, options.get('timeout', self.timeout))
+        except socket.timeout as e:
+            self.logger.error(f"Deadline exceeded when calling method {method}: {e}")
+            return None
+        if shared and isinstance(result, RPCStream):
+            return call()
+        return result
+
+    def send_request(self, tcp_client, method, args, kwargs, options, deadline, exclude=(), target=None):
+        """
+        连接服务端、发送请求并接收第一帧回复
+        :param tcp_client: TCPClient 本次请求使用的连接
+        :param deadline: float 本次调用的截止时间（time.monotonic()）
+        :param exclude: 不参与选择的服务端 (host, port)，对冲请求据此发往与主请求不同的服务端
+        :param target: 指定的服务端 (host, port)，为空则直连模式连接 self.host:self.port，注册中心模式负载均衡选出
+        :return: (服务端 (host, port), 第一帧回复)
+        """
+        # 被采样的调用记录各阶段耗时：connect 连接、serialize 序列化与打包成帧、send 发送、
+        # wait 等待服务端回复（网络往返加服务端排队与执行）、decode 解析回复
+        trace = self.tracer.start_trace() if options.get('trace', True) else None
+        start_wall, last = time.time(), time.monotonic()
+        stages = {}
+        server = target
+        try:
+            if self.mode == 0 or target is not None:
+                server = target or (self.host, self.port)
+                self.open_connection(tcp_client, server, deadline - time.monotonic())
+            else:
+                server = self.connect_server_by_registry(tcp_client, timeout=deadline - time.monotonic(),
+                                                         method=method, exclude=exclude)
+            # 直连模式无法得知服务端是否支持压缩，请求不压缩
+            server_params = self.registry_client.servers_params.get(server, {}) if self.mode == 1 else {}
+            framed = server_params.get('framing', False) if self.mode == 1 else self.framing
+            now = time.monotonic()
+            stages['connect'], last = now - last, now
+
+            # 连接耗去的时间从预算中扣除，剩余预算随请求发给服务端，服务端据此丢弃调用方已经放弃等待的请求
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("deadline exceeded before sending request")
+            tcp_client.sock.settimeout(remaining)
+
+            # 请求帧按服务端注册时声明的压缩能力与阈值压缩；同时声明本端可解压的编解码器，供服务端压缩回复
+            payload = self.encode_request(method, args, kwargs, remaining, options.get('priority', self.priority),
+                                          trace, options.get('envelope_prefix'))
+            if framed:
+                frame = FrameProtocol.pack(payload,
+                                           Compression.negotiate(server_params.get('compression')),
+                                           server_params.get('compress_threshold', 0),
+                                           self.compression_metrics)
+            else:
+                frame = payload  # 旧版服务端不分帧也不解压，直接发送 json 请求
+            now = time.monotonic()
+            stages['serialize'], last = now - last, now
+            while True:
+                sending = True
+                try:
+                    tcp_client.send(frame)
+                    sending = False
+                    now = time.monotonic()
+                    stages['send'], last = now - last, now
+                    if framed:
+                        raw = tcp_client.recv_frame(self.compression_metrics)
+                    else:
+                        raw = FrameProtocol.recv_legacy(tcp_client.sock)
+                    break
+                except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+                    # 复用的空闲连接在取出后被服务端关闭：只有发送失败或一个回复字节都没收到（EOFError）时请求才可能未被处理，
+                    # 但服务端仍可能已执行完（排空超时强制关闭连接、执行后崩溃），因此只重发重复执行安全的方法，新建连接重发一次
+                    if not tcp_client.reused or not (sending or isinstance(e, EOFError)) or not self.can_resend(method):
+                        raise
+                    tcp_client.close()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("deadline exceeded before resending request")
+                    self.connect_to(tcp_client, server, remaining, self.local_endpoint(server))
+                    tcp_client.reused = False
+            now = time.monotonic()
+            stages['wait'], last = now - last, now
+            reply = json.loads(raw.decode('utf-8'))
+            stages['decode'] = time.monotonic() - last
+        except Exception as e:
+            if trace is not None:
+                self.tracer.record(trace, method, 'CLIENT', start_wall, time.time() - start_wall, stages, server,
+                                   {'error': e})
+            raise
+        if trace is not None:
+            tags = {'error': reply['error']} if 'error' in reply else None
+            self.tracer.record(trace, method, 'CLIENT', start_wall, time.time() - start_wall, stages, server, tags)
+        return server, reply
+
+    SAFE_RESERVED_METHODS = ('all_your_methods', 'your_metrics', 'your_ping')  # 只读的保留方法，重复执行无副作用
+
+    def can_resend(self, method):
+        """方法重复执行是否安全：只读的保留方法，或注册中心模式下被服务端标记为幂等的方法"""
+        return method in self.SAFE_RESERVED_METHODS or (self.mode == 1 and self.registry_client.is_idempotent(method))
+
+    ENVELOPE_MIDDLE = (', "method_kwargs": {}, "accept_encoding": ' + json.dumps(list(Compression.PREFERENCE))).encode()
+
+    @staticmethod
+    def envelope_prefix(method):
+        """预编码的请求信封开头（方法名部分），类型化客户端桩为每个方法预先生成，调用时只需编码参数"""
+        return ('{"method_name": ' + json.dumps(method) + ', "method_args": ').encode('utf-8')
+
+    def encode_request(self, method, args, kwargs, remaining, priority, trace=None, prefix=None):
+        """
+        编码请求信封；带预编码开头 prefix 且没有关键字参数时走快速路径，直接拼接字节串，不构造信封字典
+        :return: bytes 序列化后的请求
+        """
+        if prefix is None or kwargs:
+            dic = {'method_name': method, 'method_args': args, 'method_kwargs': kwargs,
+                   'accept_encoding': list(Compression.PREFERENCE), 'timeout': remaining, 'priority': priority}
+            if trace is not None:
+                dic['trace'] = trace
+            return json.dumps(dic).encode('utf-8')
+        tail = f', "timeout": {remaining!r}, "priority": {json.dumps(priority)}'
+        if trace is not None:
+            tail += f', "trace": {json.dumps(trace)}'
+        return prefix + json.dumps(args).encode('utf-8') + self.ENVELOPE_MIDDLE + tail.encode('utf-8') + b'}'
+
+    @staticmethod
+    def load_method_table(path):
+        """从 JSON 文件读取方法表，文件内容为 all_your_methods 的返回值"""
+        with open(path) as f:
+            return json.load(f)
+
+    def method_table(self, path=None):
+        """
+        获取服务端方法表（方法名、必需参数与带默认值的参数）：path 不为空时从 JSON 文件读取；
+        注册中心模式优先使用各服务端注册时发布的方法表，无需额外请求；否则调用保留方法 all_your_methods
+        :return: list 方法信息字典列表
+        """
+        if path is not None:
+            return self.load_method_table(path)
+        if self.mode == 1:
+            methods = {}
+            for params in list(self.registry_client.servers_params.values()):
+                for method in params.get('methods', []):
+                    methods.setdefault(method['method_name'], method)
+            if methods:
+                return list(methods.values())
+        methods = self.all_your_methods()
+        if not isinstance(methods, list):
+            raise Exception(f"Failed to fetch method table: {methods}")
+        return methods
+
+    def stub(self, class_name='RPCStub', path=None, **options):
+        """
+        生成并实例化类型化客户端桩，如 client.stub().add(1, 2)；参数错误在本地即抛出 TypeError，不必等一次往返
+        :param class_name: string 生成的类名
+        :param path: string 方法表 JSON 文件，为空则从服务端获取
+        :param options: 调用选项，同 invoke 的 options（如 timeout、priority）
+        """
+        namespace = {}
+        exec(StubGenerator.generate(self.method_table(path), class_name), namespace)
+        return namespace[class_name](self, **options)
+
+    def handle_reply(self, tcp_client, server, method, args, kwargs, reply):
+        """
+        处理第一帧回复：普通回复关闭连接并返回结果，流式回复把连接交由 RPCStream 持有
+        :return: 调用结果或 RPCStream
+        """
+        host, port = server
+        if reply.get("stream") == "begin":
+            # 流式回复：连接交由 RPCStream 持有，随迭代逐项接收；超时时间只约束到流开始，之后每帧按默认超时等待
+            tcp_client.sock.settimeout(self.timeout)
+            result = RPCStream(tcp_client, reply["window"], self.logger, method,
+                               self.compression_metrics)
+            self.logger.info(
+                f"Call method: {method} args:{args} kwargs:{kwargs} | result: <stream> ｜ server: {host}:{port}")
+        else:
+            result = reply["res"]
+            self.release_connection(tcp_client)
+            if "error" in reply:
+                self.logger.error(
+                    f"Call method: {method} args:{args} kwargs:{kwargs} | error: {result} ｜ server: {host}:{port}")
+            else:
                 self.logger.info(
-                    f"Call method: {method} args:{args} kwargs:{kwargs} | result: {result} ｜ server: {self.host}:{self.port}")
+                    f"Call method: {method} args:{args} kwargs:{kwargs} | result: {result} ｜ server: {host}:{port}")
+        return result
+
+    def hedged_invoke(self, method, args, kwargs, options, deadline):
+        """
+        对冲调用（仅用于服务端标记为幂等的方法）：主请求超过对冲延迟仍未返回时，在预算允许且有其他服务端可选时，
+        向另一个服务端发送相同请求，采用先到达的回复，并断开落后请求的连接；
+        连接或通信失败的请求不算作回复，继续等待另一个。
+        注意断开连接只是客户端不再等待落后的请求，协议中没有取消消息，已开始执行的服务端仍会执行完（回复写入时才发现连接已断开），
+        因此对冲的方法会被执行两次，只应对幂等方法开启，并通过 hedge_budget 限制额外负载
+        :return: 同 invoke
+        """
+        delay = options.get('hedge_delay', self.hedge_delay)
+        if delay is None:
+            delay = self.latency_tracker.percentile(method, 0.95)  # 样本不足时为 None，本次不对冲
+        self.hedge_budget.deposit()
+        replies = queue.Queue()
+        lock = threading.Lock()
+        attempts = []
+        done = [False]
+
+        def attempt(tcp_client, exclude):
+            outcome = None
+            try:
+                server, reply = self.send_request(tcp_client, method, args, kwargs, options, deadline, exclude)
+                outcome = (tcp_client, server, reply, None)
             except Exception as e:
-                self.logger.error(f"Error occurred when calling method {method}: {e}")
-                result = None
+                outcome = (tcp_client, None, None, e)
+            finally:
+                with lock:
+                    # 失败的请求、已有其他请求胜出后落后的请求都直接关闭连接：连接上可能还有未读完的回复，不能放回连接池
+                    if (outcome is None or outcome[3] is not None or done[0]) and tcp_client.sock is not None:
+                        tcp_client.close()
+                    if outcome is not None and not done[0]:
+                        replies.put(outcome)
 
-            return result
+        def launch(exclude=()):
+            tcp_client = TCPClient()
+            attempts.append(tcp_client)
+            threading.Thread(target=attempt, args=(tcp_client, exclude), daemon=True).start()
 
-        setattr(self, method, _func)
-        return _func
+        start = time.monotonic()
+        launch()
+        hedged = False
+        outcome = None
+        last_error = None
+        while outcome is None and len(attempts) > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                last_error = socket.timeout("deadline exceeded")
+                break
+            wait = remaining if hedged or delay is None else max(0.0, min(remaining, start + delay - time.monotonic()))
+            try:
+                tcp_client, server, reply, error = replies.get(timeout=wait)
+            except queue.Empty:
+                if not hedged and delay is not None:
+                    hedged = True
+                    primary = attempts[0]
+                    exclude = ((primary.host, primary.port),)
+                    others = [s for s in self.registry_client.servers_for_method(method)
+                              if s not in exclude and s not in self.unhealthy]
+                    if others and self.hedge_budget.withdraw():
+                        self.logger.info(f"Call method: {method} not answered in {delay * 1000:.0f}ms, "
+                                         f"hedging to another server")
+                        launch(exclude)
+                continue
+            attempts.remove(tcp_client)
+            if error is None:
+                outcome = (tcp_client, server, reply)
+            else:
+                last_error = error
+        with lock:
+            done[0] = True
+            # 断开仍在进行的落后请求：shutdown 能唤醒阻塞在 recv 上的线程，服务端也随之感知连接断开
+            for tcp_client in attempts:
+                if tcp_client.sock is not None:
+                    try:
+                        tcp_client.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            while not replies.empty():
+                tcp_client = replies.get()[0]
+                if tcp_client.sock is not None:
+                    tcp_client.close()
+
+        if outcome is None:
+            if isinstance(last_error, socket.timeout):
+                self.logger.error(f"Deadline exceeded when calling method {method}: {last_error}")
+            else:
+                self.logger.error(f"Error occurred when calling method {method}: {last_error}")
+            return None
+        tcp_client, server, reply = outcome
+        self.latency_tracker.record(method, time.monotonic() - start)
+        try:
+            return self.handle_reply(tcp_client, server, method, args, kwargs, reply)
+        except Exception as e:
+            self.logger.error(f"Error occurred when calling method {method}: {e}")
+            tcp_client.close()
+            return None
 
-    def connect_server_by_registry(self, tcp_client, protocol="json"):
+    def connect_server_by_registry(self, tcp_client, protocol="json", timeout=10, method=None, exclude=()):
         """
         通过注册中心连接服务端模式下连接服务端, 此模式下轮询注册中心线程开启，
-        优先使用本地服务端缓存，为空则调用registry_client的findRpcServers，若结果仍为空则抛出无可用服务端异常
+        优先使用本地服务端缓存（包括启动时从缓存文件加载的，过期的也照常使用，由轮询线程在后台刷新），
+        为空则调用registry_client的findRpcServers，若结果仍为空则抛出无可用服务端异常；
+        指定方法时只在提供该方法的服务端中选择，本地没有则向注册中心按方法查询
         并在此处使用负载均衡类的负载均衡算法选出最终连接的服务端，进行连接
         :param tcp_client: TCPClient 与选出的server建立连接的tcp客户端
         :param protocol: 客户端使用的消息数据格式
+        :param timeout: float 连接超时时间（秒）
+        :param method: string 要调用的方法名，为 None 或保留方法时不按方法筛选
+        :param exclude: 不参与选择的服务端 (host, port)
+        :return: 选出并连接上的服务端 (host, port)
+        """
+        servers = self.candidate_servers(method, protocol)
+        if exclude:
+            servers = [server for server in servers if server not in exclude]
+            if len(servers) == 0:
+                raise Exception(f"No available servers other than {exclude}")
+
+        # 选用不同负载均衡算法的例子
+        # server = LoadBalance.round_robin(servers)  # 轮询
+        # server = LoadBalance.weighted_random(servers, weights) # 加权随机
+        server = LoadBalance.random(self.prefer_healthy(servers))  # 随机
+        self.host, self.port = server  # just for print log
+
+        try:
+            self.open_connection(tcp_client, server, timeout)
+        except Exception as e:
+            self.registry_client.discard_server(server)
+            raise Exception(f"Failed to connect to rpc server, {e}")
+        return server
+
+    def candidate_servers(self, method=None, protocol="json"):
+        """
+        注册中心模式下可供选择的服务端：优先使用本地服务端缓存，为空则调用registry_client的findRpcServers；
+        指定方法时只保留提供该方法的服务端，本地没有则向注册中心按方法查询；结果为空时抛出无可用服务端异常
+        :param method: string 要调用的方法名，为 None 或保留方法时不按方法筛选
+        :return: (host, port) 的元组 list
         """
         if len(self.registry_client.servers_cache) == 0:
             servers = self.registry_client.findRpcServers(protocol)
@@ -211,35 +1468,261 @@ class RPCClient:
             servers = list(self.registry_client.servers_cache)
         if len(servers) == 0:
             raise Exception(f"No available servers")
+        if method is not None and method not in self.RESERVED_METHODS:
+            servers = self.registry_client.servers_for_method(method) or \
+                      self.registry_client.findRpcServersByMethod(method, protocol)
+            if len(servers) == 0:
+                raise Exception(f"No available servers providing method {method}")
+        return servers
 
-        # 选用不同负载均衡算法的例子
-        # server = LoadBalance.round_robin(servers)  # 轮询
-        # server = LoadBalance.weighted_random(servers, weights) # 加权随机
-        server = LoadBalance.random(servers)  # 随机
-        host, port = server
-        self.host, self.port = host, port  # just for print log
+    def prefer_healthy(self, servers):
+        """
+        负载均衡选出单个服务端前按健康探测结果筛选：优先选择探测成功、已预建连接的服务端，跳过探测失败的服务端；
+        都不满足时仍照常选择，避免探测误判导致无服务端可用。map / broadcast 要覆盖所有服务端，不经过此筛选
+        """
+        if not self.probe_interval:
+            return servers
+        healthy = [server for server in servers if server not in self.unhealthy]
+        return [server for server in healthy if server in self.probe_rtt] or healthy or servers
 
+    def local_endpoint(self, server):
+        """
+        同一台机器上的服务端若声明了 Unix 域 socket，改走 Unix 域 socket，省去回环 TCP 协议栈的开销
+        :return: 实际连接的地址，('unix:/path', 0) 或原 (host, port)
+        """
+        if self.mode == 0 or not self.prefer_unix:
+            return server
+        params = self.registry_client.servers_params.get(server, {})
+        path = params.get('unix_socket')
+        if path and params.get('hostname') == self.hostname and os.path.exists(path):
+            return 'unix:' + path, 0
+        return server
+
+    def open_connection(self, tcp_client, server, timeout):
+        """
+        连接指定服务端：优先复用连接池中的空闲连接，没有则新建连接
+        :param timeout: float 新建连接的超时时间（秒）
+        """
+        sock = self.pool.acquire(server)
+        if sock is None:
+            tcp_client.reused = False
+            self.connect_to(tcp_client, server, timeout, self.local_endpoint(server))
+            return
+        tcp_client.sock = sock
+        tcp_client.host, tcp_client.port = server
+        tcp_client.reused = True
+
+    def release_connection(self, tcp_client):
+        """调用结束后把连接放回连接池"""
+        self.pool.release((tcp_client.host, tcp_client.port), tcp_client.sock)
+        tcp_client.sock = None
+
+    @staticmethod
+    def connect_to(tcp_client, server, timeout, endpoint=None):
+        """
+        按地址类型创建 socket 并连接指定服务端
+        :param server: (host, port) 同时支持 IPv4 和 IPv6，host 为 'unix:/path' 时连接 Unix 域 socket
+        :param timeout: float 连接超时时间（秒）
+        :param endpoint: 实际连接的地址，为空则连接 server
+        """
+        tcp_client.host, tcp_client.port = server
+        host, port = endpoint or server
+        if host.startswith('unix:'):
+            tcp_client.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            tcp_client.sock.settimeout(timeout)
+            tcp_client.sock.connect(host[len('unix:'):])
+            return
         if '.' in host:
             addr_type = socket.AF_INET
         else:
             addr_type = socket.AF_INET6
         tcp_client.sock = socket.socket(addr_type, socket.SOCK_STREAM)
-        tcp_client.sock.settimeout(10)
+        tcp_client.sock.settimeout(timeout)
+        tcp_client.connect(host, port)
 
+    def call_server(self, server, method, args, kwargs, options=None):
+        """
+        向指定服务端发起一次调用，出错不抛出异常，而是和服务端的错误回复一样体现在返回值中；流式结果收齐为列表
+        :param server: (host, port)
+        :return: dict {'server': (host, port), 'res': 结果或错误信息, 'error': 错误类型，成功时为 None}
+        """
+        options = options or {}
+        deadline = time.monotonic() + options.get('timeout', self.timeout)
+        tcp_client = TCPClient()
         try:
-            tcp_client.connect(host, port)
+            server, reply = self.send_request(tcp_client, method, args, kwargs, options, deadline, target=server)
+            result = self.handle_reply(tcp_client, server, method, args, kwargs, reply)
+            if isinstance(result, RPCStream):
+                with result:
+                    result = list(result)
+            return {'server': server, 'res': result, 'error': reply.get('error')}
+        except socket.timeout as e:
+            self.logger.error(f"Deadline exceeded when calling method {method} on {server}: {e}")
+            error, message = 'deadline_exceeded', str(e)
+        except RPCStreamError as e:
+            self.logger.error(f"Stream of method {method} failed on {server}: {e}")
+            error, message = 'stream', str(e)
         except Exception as e:
-            if server in self.registry_client.servers_cache:
-                self.registry_client.servers_cache.remove(server)
-            raise Exception(f"Failed to connect to rpc server, {e}")
+            self.logger.error(f"Error occurred when calling method {method} on {server}: {e}")
+            error, message = 'unavailable', str(e)
+        if tcp_client.sock is not None:
+            tcp_client.close()
+        return {'server': server, 'res': message, 'error': error}
+
+    def map(self, method, iterable_of_args, concurrency=4, ordered=True, timeout=None):
+        """
+        把一批调用分散到提供该方法的所有服务端并行执行，逐项产出结果。
+        每个服务端有 concurrency 个工作线程，即每个服务端最多同时执行 concurrency 个调用；
+        所有工作线程从同一个任务源领取任务，处理快的服务端自然领得多，分布不会因随机选择而不均
+        :param method: string 方法名
+        :param iterable_of_args: 每项为一次调用的参数：tuple/list 为位置参数，dict 为关键字参数，其他值为单个位置参数；
+                                 按需逐项读取，可以是生成器
+        :param concurrency: int 每个服务端的并发调用上限
+        :param ordered: bool True 按输入顺序产出结果，False 按完成顺序产出
+        :param timeout: float 每次调用的超时时间（秒），默认使用 self.timeout
+        :return: 生成器，每项为 dict {'index': 输入序号, 'server': (host, port), 'res': 结果或错误信息,
+                 'error': 错误类型，成功时为 None}，单项失败不影响其他项；
+                 iterable_of_args 本身抛出异常时不再领取新任务，已领取的调用完成并产出后把该异常抛给调用方
+        """
+        servers = [(self.host, self.port)] if self.mode == 0 else self.candidate_servers(method)
+        options = {'timeout': timeout or self.timeout}
+        items = enumerate(iterable_of_args)
+        items_lock = threading.Lock()
+        results = queue.Queue()
+        stop_e = threading.Event()  # 调用方提前结束迭代、或输入迭代器出错时通知工作线程不再领取任务
+        failures = []  # 输入迭代器抛出的异常
+
+        def worker(server):
+            try:
+                while not stop_e.is_set():
+                    with items_lock:
+                        try:
+                            index, item = next(items)
+                        except StopIteration:
+                            break
+                        except Exception as e:
+                            failures.append(e)
+                            stop_e.set()
+                            break
+                    if isinstance(item, dict):
+                        args, kwargs = (), item
+                    elif isinstance(item, (tuple, list)):
+                        args, kwargs = tuple(item), {}
+                    else:
+                        args, kwargs = (item,), {}
+                    results.put(dict(index=index, **self.call_server(server, method, args, kwargs, options)))
+            finally:
+                results.put(None)  # 本工作线程结束，无论是否出错都要通知，否则调用方会一直等待
+
+        workers = [threading.Thread(target=worker, args=(server,), daemon=True)
+                   for server in servers for _ in range(concurrency)]
+        for thread in workers:
+            thread.start()
+        running = len(workers)
+        buffered = {}
+        next_index = 0
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                elif not ordered:
+                    yield result
+                else:
+                    buffered[result['index']] = result
+                    while next_index in buffered:
+                        yield buffered.pop(next_index)
+                        next_index += 1
+        finally:
+            stop_e.set()
+        if failures:
+            raise failures[0]
+
+    def broadcast(self, method, args=(), kwargs=None, timeout=None):
+        """
+        在提供该方法的每个服务端上各调用一次（如让所有实例刷新配置、收集各实例状态），并行执行，按完成顺序产出结果
+        :param timeout: float 每次调用的超时时间（秒），默认使用 self.timeout
+        :return: 生成器，每项为 call_server 的返回值，每个服务端一项
+        """
+        servers = [(self.host, self.port)] if self.mode == 0 else self.candidate_servers(method)
+        options = {'timeout': timeout or self.timeout}
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            futures = [executor.submit(self.call_server, server, method, tuple(args), kwargs or {}, options)
+                       for server in servers]
+            for future in as_completed(futures):
+                yield future.result()
 
     def poll_registry(self):
         while self.running:
             self.registry_client.findRpcServers()
             time.sleep(3)
 
+    def loop_probe(self):
+        """健康探测线程：每 probe_interval 秒并行探测一次所有服务端，并清理已下线服务端的空闲连接和探测状态"""
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            while self.running:
+                start = time.monotonic()
+                servers = set(self.registry_client.servers_cache)
+                self.pool.retain(servers)
+                for server in list(self.probed):
+                    if server not in servers:
+                        self.probed.discard(server)
+                        self.unhealthy.discard(server)
+                        self.probe_rtt.pop(server, None)
+                list(executor.map(self.probe, servers))
+                time.sleep(max(0.0, self.probe_interval - (time.monotonic() - start)))
+
+    def probe(self, server):
+        """
+        向服务端发送一次 your_ping 并测量往返时间，收到任何回复即视为健康；失败则标记为不健康，选服务端时跳过，
+        并关闭连接池中该服务端的空闲连接（服务端卡死、重启或网络中断时这些连接多半已不可用，留着只会让恢复后的调用先踩到坏连接）。
+        首次探测的服务端以及恢复健康的服务端先预建 prewarm 个连接放入连接池，真实调用路由过去时无需再建连
+        :param server: (host, port)
+        """
+        if server not in self.probed:
+            self.probed.add(server)
+            self.prewarm_connections(server)
+        tcp_client = TCPClient()
+        start = time.monotonic()
+        try:
+            self.send_request(tcp_client, 'your_ping', (), {}, {'timeout': self.probe_timeout, 'trace': False},
+                              start + self.probe_timeout, target=server)
+        except Exception as e:
+            if tcp_client.sock is not None:
+                tcp_client.close()
+            self.pool.discard(server)
+            if server not in self.unhealthy:
+                self.unhealthy.add(server)
+                self.logger.error(f"Health probe to {server[0]}:{server[1]} failed, marked unhealthy: {e}")
+            return
+        rtt = time.monotonic() - start
+        self.release_connection(tcp_client)
+        previous = self.probe_rtt.get(server)
+        self.probe_rtt[server] = rtt if previous is None else 0.8 * previous + 0.2 * rtt
+        if server in self.unhealthy:
+            self.unhealthy.discard(server)
+            self.logger.info(f"Health probe to {server[0]}:{server[1]} answered in {rtt * 1000:.1f}ms, "
+                             f"marked healthy")
+            self.prewarm_connections(server)
+
+    def prewarm_connections(self, server):
+        """预先建立连接补足到 prewarm 个空闲连接，连接失败即停止，由随后的探测标记为不健康"""
+        for _ in range(self.prewarm - self.pool.size(server)):
+            tcp_client = TCPClient()
+            try:
+                self.connect_to(tcp_client, server, self.probe_timeout, self.local_endpoint(server))
+            except Exception:
+                if tcp_client.sock is not None:
+                    tcp_client.close()
+                return
+            self.release_connection(tcp_client)
+
     def stop(self):
         self.running = False
+        self.pool.close()
+        self.logger.info(f"Compression metrics: {self.compression_metrics.snapshot()}")
+        self.logger.info(f"Coalesced calls: {self.single_flight.shared}")
+        self.tracer.flush()
 
 
 def test_sync_calls(client):
@@ -262,19 +1745,100 @@ def test_async_calls(client):
     client.logger.info('异步调用测试完成\n')
 
 
+def test_coalesced_calls(client):
+    client.logger.info('合并调用测试开始')
+    with ThreadPoolExecutor(max_workers=30) as executor:
+        futures = [executor.submit(client.with_coalescing().hi, 'everyone') for _ in range(30)]
+        for future in futures:
+            future.result()
+    client.logger.info(f'合并调用测试完成，共有 {client.single_flight.shared} 次调用共享了进行中调用的结果\n')
+
+
+def test_stream_calls(client):
+    client.logger.info('流式调用测试开始')
+    stream = client.count_up(100)
+    if stream is not None:
+        total = 0
+        for item in stream:
+            total += item
+        client.logger.info(f'流式调用共收到 {stream.count} 项，求和为 {total}')
+    client.logger.info('流式调用测试完成\n')
+
+
+def test_hedged_calls(client):
+    client.logger.info('对冲调用测试开始')
+    # 只有一个服务端时没有可对冲的目标，照常等待主请求
+    client.with_hedging(0.2).slow_echo('hedged', 0.5)
+    client.logger.info('对冲调用测试完成\n')
+
+
+def test_map_calls(client):
+    client.logger.info('批量调用测试开始')
+    results = list(client.map('add', [(i, i) for i in range(20)], concurrency=2))
+    failed = [result for result in results if result['error'] is not None]
+    client.logger.info(f'批量调用 {len(results)} 项，失败 {len(failed)} 项，'
+                       f'成功项求和为 {sum(result["res"] for result in results if result["error"] is None)}')
+    for result in client.broadcast('hi', ('broadcast',)):
+        client.logger.info(f'广播调用 {result["server"]} 返回 {result["res"]}')
+    client.logger.info('批量调用测试完成\n')
+
+
+def test_deadline_calls(client):
+    client.logger.info('超时调用测试开始')
+    client.with_timeout(2).slow_echo('in time', 0.5)
+    client.with_timeout(0.2).slow_echo('too late', 0.5)
+    client.logger.info('超时调用测试完成\n')
+
+
+def test_stub_calls(client):
+    """类型化客户端桩调用测试"""
+    client.logger.info('类型化客户端桩调用测试')
+    stub = client.stub()
+    client.logger.info(f'stub methods: {stub.METHODS}')
+    if 'add' in stub.METHODS:
+        client.logger.info(f'add(1, 2) = {stub.add(1, 2)}')
+        try:
+            stub.add(1)
+        except TypeError as e:
+            client.logger.info(f'参数在本地校验失败: {e}')
+    client.logger.info('类型化客户端桩调用测试完成\n')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='TCP/JSON RPC Client')
-    parser.add_argument('-i', '--host', type=str, help='客户端需要发送的服务端 ip 地址，同时支持 IPv4 和 IPv6，不得为空')
+    parser.add_argument('-i', '--host', type=str,
+                        help='客户端需要发送的服务端 ip 地址，同时支持 IPv4 和 IPv6，不得为空；unix:/path 表示服务端的 Unix 域 socket，此时无需端口')
     parser.add_argument('-p', '--port', type=int, help='客户端需要发送的服务端端口，不得为空')
     parser.add_argument('-m', '--mode', type=str, default='registry', choices=['registry', 'server'],
                         help='客户端运行模式，默认值为 server，可选值为 registry (通过注册中心发现服务)和 server(直接与服务端相连)。在 registry 模式下，无需指定 '
                              'host 和 port 参数')
+    parser.add_argument('--generate-stub', type=str, metavar='PATH',
+                        help='根据服务端方法表生成类型化客户端桩源代码写入 PATH 后退出，PATH 为 - 时输出到标准输出')
+    parser.add_argument('--methods-file', type=str,
+                        help='生成客户端桩时使用的方法表 JSON 文件（all_your_methods 的返回值），为空则从服务端获取')
+    parser.add_argument('--stub-class', type=str, default='RPCStub', help='生成的客户端桩类名，默认值为 RPCStub')
 
     args = parser.parse_args()
 
-    if args.mode == 'server' and (not args.host or not args.port):
+    if args.mode == 'server' and (not args.host or (not args.port and not args.host.startswith('unix:'))):
         parser.error("在server模式下，必须指定host和port参数")
 
+    if args.generate_stub and args.methods_file:
+        source = StubGenerator.generate(RPCClient.load_method_table(args.methods_file), args.stub_class)
+    elif args.generate_stub:
+        client = RPCClient(host=args.host, port=args.port)
+        try:
+            source = StubGenerator.generate(client.method_table(), args.stub_class)
+        finally:
+            client.stop()
+    if args.generate_stub:
+        if args.generate_stub == '-':
+            print(source, end='')
+        else:
+            with open(args.generate_stub, 'w') as f:
+                f.write(source)
+        exit(0)
+
     client = RPCClient(host=args.host, port=args.port)
     try:
         # 同步调用测试
@@ -283,6 +1847,26 @@ if __name__ == '__main__':
         # 异步调用测试
         test_async_calls(client)
 
+        # 合并调用测试
+        if client.mode == 1:
+            test_coalesced_calls(client)
+
+        # 流式调用测试
+        test_stream_calls(client)
+
+        # 批量调用测试
+        test_map_calls(client)
+
+        # 超时调用测试
+        test_deadline_calls(client)
+
+        # 类型化客户端桩调用测试
+        test_stub_calls(client)
+
+        # 对冲调用测试
+        if client.mode == 1:
+            test_hedged_calls(client)
+
     except KeyboardInterrupt:
         client.logger.info(f"Main thread received KeyboardInterrupt, stopping...")
     finally:
@@ -1,13 +1,15 @@
 import argparse
+import http.client
 import json
 import os
+import queue
 import socket
 import threading
 import time
 from collections import defaultdict
 from datetime import datetime
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
-from typing import List
+from typing import List, Optional
 from urllib.parse import urlparse, parse_qs
 
 
@@ -93,51 +95,320 @@ class InstanceMeta:
                 f"status={self.status}, parameters={self.parameters})")
 
 
+class RegistryStore:
+    """
+    注册中心本地持久化：追加写的变更日志 + 定期压缩生成的快照。
+    启动时先读快照再重放其后的变更日志，即可恢复重启前的完整服务实例列表。
+    只记录注册（含参数变化）与注销，心跳只更新内存中的时间戳，不写盘
+    """
+    SNAPSHOT_FILE = 'snapshot.json'
+    LOG_FILE = 'changes.log'
+
+    def __init__(self, data_dir: str, logger: Logger, compact_every: int = 1000, snapshot_interval: int = 60):
+        """
+        :param data_dir: 数据目录
+        :param logger: 日志
+        :param compact_every: 变更日志累积这么多条后压缩为快照
+        :param snapshot_interval: 距上次快照超过这么多秒且有新变更时压缩为快照
+        """
+        self.data_dir = data_dir
+        self.logger = logger
+        self.compact_every = compact_every
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_path = os.path.join(data_dir, self.SNAPSHOT_FILE)
+        self.log_path = os.path.join(data_dir, self.LOG_FILE)
+        self.lock = threading.Lock()
+        self.log_entries = 0  # 上次快照以来的变更条数
+        self.revision = 0  # load 后为持久化中记录的最新修订号
+        self.last_snapshot = time.time()
+        os.makedirs(data_dir, exist_ok=True)
+        self.log_file = None
+
+    def load(self) -> List[InstanceMeta]:
+        """读取快照并重放变更日志，返回恢复出的服务实例，之后打开变更日志准备追加"""
+        instances = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self.revision = snapshot.get('revision', 0)
+            for data in snapshot['instances']:
+                ins = InstanceMeta.from_dict(data)
+                instances[ins] = ins
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 进程在写某一行时崩溃，只会损坏最后一行，丢弃即可
+                        self.logger.error(f"Skip broken change log line: {line!r}")
+                        continue
+                    ins = InstanceMeta.from_dict(entry['instance'])
+                    if entry['op'] == 'register':
+                        instances.pop(ins, None)
+                        instances[ins] = ins
+                    else:
+                        instances.pop(ins, None)
+                    self.revision = max(self.revision, entry.get('revision', 0))
+                    self.log_entries += 1
+        self.log_file = open(self.log_path, 'a')
+        return list(instances.values())
+
+    def append(self, op: str, ins: InstanceMeta, revision: int):
+        """追加一条变更，op 为 register 或 unregister，revision 为该变更后的修订号"""
+        with self.lock:
+            self.log_file.write(json.dumps({'op': op, 'ts': time.time(), 'revision': revision,
+                                            'instance': ins.to_dict()}) + '\n')
+            self.log_file.flush()
+            self.log_entries += 1
+
+    def need_compact(self) -> bool:
+        return self.log_entries >= self.compact_every or (
+                self.log_entries > 0 and time.time() - self.last_snapshot >= self.snapshot_interval)
+
+    def compact(self, instances: List[InstanceMeta], revision: int):
+        """把当前完整实例列表写成新快照（先写临时文件再原子替换），然后清空变更日志"""
+        with self.lock:
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'ts': time.time(), 'revision': revision,
+                           'instances': [ins.to_dict() for ins in instances]}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            self.log_file.close()
+            self.log_file = open(self.log_path, 'w')
+            self.log_entries = 0
+            self.last_snapshot = time.time()
+        self.logger.info(f"Registry snapshot written with {len(instances)} instances\n")
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+
+
+class RegistryReplicator:
+    """
+    注册中心集群模式下的变更复制：本节点直接收到的注册、心跳（租约续期）与注销，
+    由后台线程攒批后异步发给所有对等节点；对等节点应用后不再转发，避免循环。
+    复制失败只记日志不重试，服务端下一次心跳会重新带上完整信息
+    """
+
+    def __init__(self, peers: List[tuple], logger: Logger, batch_interval: float = 0.2):
+        """
+        :param peers: 对等注册中心节点 (host, port) 列表
+        :param logger: 日志
+        :param batch_interval: 攒批等待时间（秒）
+        """
+        self.peers = peers
+        self.logger = logger
+        self.batch_interval = batch_interval
+        self.changes = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self.loop_replicate, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def publish(self, op: str, ins: InstanceMeta):
+        """登记一条需要复制的变更，op 为 register 或 unregister"""
+        self.changes.put({'op': op, 'instance': ins.to_dict()})
+
+    def loop_replicate(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = [self.changes.get(timeout=1)]
+            except queue.Empty:
+                continue
+            time.sleep(self.batch_interval)  # 攒一小段时间内的变更一起发送，心跳密集时减少请求数
+            while True:
+                try:
+                    batch.append(self.changes.get_nowait())
+                except queue.Empty:
+                    break
+            body = json.dumps(batch)
+            for host, port in self.peers:
+                conn = http.client.HTTPConnection(host, port, timeout=5)
+                try:
+                    conn.request("POST", "/myRegistry/replicate", body, {'Content-type': 'application/json'})
+                    conn.getresponse().read()
+                except (OSError, http.client.HTTPException) as e:
+                    self.logger.error(f"Replicate {len(batch)} changes to peer {host}:{port} failed: {e}")
+                finally:
+                    conn.close()
+
+    def pull_from_peers(self) -> List[InstanceMeta]:
+        """启动时从第一个可达的对等节点拉取完整实例列表，用于新节点加入或节点重启后追上集群状态"""
+        for host, port in self.peers:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            try:
+                conn.request("GET", "/myRegistry/dump")
+                response = conn.getresponse()
+                if response.status == 200:
+                    instances = [InstanceMeta.from_dict(data) for data in json.loads(response.read().decode())]
+                    self.logger.info(f"Pulled {len(instances)} instances from peer {host}:{port}")
+                    return instances
+            except (OSError, http.client.HTTPException) as e:
+                self.logger.error(f"Pull instances from peer {host}:{port} failed: {e}")
+            finally:
+                conn.close()
+        return []
+
+    def stop(self):
+        self._stop_event.set()
+
+
 class RegistryService:
     """注册中心服务类"""
 
-    def __init__(self, logger: Logger):
+    def __init__(self, logger: Logger, store: Optional[RegistryStore] = None, grace_period: int = 15,
+                 replicator: Optional[RegistryReplicator] = None):
+        """
+        :param logger: 日志
+        :param store: 本地持久化，为空则只在内存中保存
+        :param grace_period: 从持久化恢复后的宽限期（秒），期间不因心跳超时摘除实例，等待各服务端重新发来心跳
+        :param replicator: 集群模式下的变更复制，为空则为单节点模式
+        """
         self.proto2instances = defaultdict(list)  # 存不同序列化数据格式对应的服务实例
+        self.method2instances = defaultdict(list)  # 方法名到提供该方法的服务实例的倒排索引，服务实例注册时发布方法表
         self.ins2timestamp = defaultdict(int)  # 存各个服务实例的时间戳，用于心跳检测
         self.logger = logger  # 日志
+        self.store = store
+        self.lock = threading.RLock()  # 保证内存状态与变更日志的顺序一致
+        self.grace_until = 0
+        self.revision = 0  # 实例列表每变化一次加一，随服务发现结果返回，客户端据此判断列表是否有变化
+        self.replicator = replicator
+        if store is not None:
+            self.restore(grace_period)
+        if replicator is not None:
+            for ins in replicator.pull_from_peers():
+                self.register(ins, replicate=False)
+            self.grace_until = int(time.time()) + grace_period
+            replicator.start()
         self._stop_event = threading.Event()
         self._health_thread = threading.Thread(target=self.loop_check_health)  # 心跳检测线程
         self._health_thread.start()
 
-    def register(self, ins: InstanceMeta) -> InstanceMeta:
-        """处理服务实例注册"""
+    def restore(self, grace_period: int):
+        """从本地持久化恢复服务实例列表，恢复的实例视为刚刚发过心跳，并在宽限期内不做超时摘除"""
+        start = time.time()
+        instances = self.store.load()
+        self.revision = self.store.revision
+        now = int(time.time())
+        for ins in instances:
+            ins.set_status(True)
+            self.proto2instances[ins.protocol].append(ins)
+            self.index_methods(ins)
+            self.ins2timestamp[ins] = now
+        self.grace_until = now + grace_period
+        self.logger.info(f"Restored {len(instances)} instances from {self.store.data_dir} "
+                         f"in {(time.time() - start) * 1000:.1f}ms, grace period {grace_period}s\n")
+
+    def register(self, ins: InstanceMeta, replicate: bool = True) -> InstanceMeta:
+        """处理服务实例注册（心跳同样走注册），replicate 为 False 表示变更来自对等节点，不再转发"""
         proto = ins.protocol
-        if ins in self.proto2instances[proto]:
-            self.logger.info(f"Register already exists instance=> {ins}")
+        if replicate and self.replicator is not None:
+            self.replicator.publish('register', ins)
+        with self.lock:
+            if ins in self.proto2instances[proto]:
+                self.logger.info(f"Register already exists instance=> {ins}")
+                ins.set_status(True)
+                # 用最新一次注册/心跳携带的参数覆盖旧参数，服务端重启后参数（如压缩能力）变化能及时生效
+                instances = self.proto2instances[proto]
+                index = instances.index(ins)
+                if instances[index].parameters != ins.parameters:
+                    self.revision += 1
+                    if self.store is not None:
+                        self.store.append('register', ins, self.revision)
+                    self.unindex_methods(instances[index])
+                    self.index_methods(ins)
+                else:
+                    self.replace_indexed(ins)
+                instances[index] = ins
+                old_time = self.ins2timestamp[ins]
+                self.logger.info(f"Its last registered time: {datetime.fromtimestamp(old_time).strftime('%Y-%m-%d %H:%M:%S')}")
+                self.ins2timestamp[ins] = int(time.time())
+                new_time = self.ins2timestamp[ins]
+                self.logger.info(f"Updated its timestamp: {datetime.fromtimestamp(new_time).strftime('%Y-%m-%d %H:%M:%S')}\n")
+                return ins
+            self.logger.info(f"Register instance=> {ins}\n")
             ins.set_status(True)
-            old_time = self.ins2timestamp[ins]
-            self.logger.info(f"Its last registered time: {datetime.fromtimestamp(old_time).strftime('%Y-%m-%d %H:%M:%S')}")
+            self.revision += 1
+            if self.store is not None:
+                self.store.append('register', ins, self.revision)
+            self.proto2instances[proto].append(ins)
+            self.index_methods(ins)
             self.ins2timestamp[ins] = int(time.time())
-            new_time = self.ins2timestamp[ins]
-            self.logger.info(f"Updated its timestamp: {datetime.fromtimestamp(new_time).strftime('%Y-%m-%d %H:%M:%S')}\n")
             return ins
-        self.logger.info(f"Register instance=> {ins}\n")
-        ins.set_status(True)
-        self.proto2instances[proto].append(ins)
-        self.ins2timestamp[ins] = int(time.time())
-        return ins
-
-    def unregister(self, ins: InstanceMeta) -> InstanceMeta:
-        """处理服务实例注销"""
+
+    def unregister(self, ins: InstanceMeta, replicate: bool = True) -> InstanceMeta:
+        """处理服务实例注销，replicate 为 False 表示变更来自对等节点或本节点心跳超时摘除，不转发"""
         proto = ins.protocol
-        if ins not in self.proto2instances[proto]:
-            self.logger.info(f"Unregister an instance not found=> {ins}\n")
+        if replicate and self.replicator is not None:
+            self.replicator.publish('unregister', ins)
+        with self.lock:
+            if ins not in self.proto2instances[proto]:
+                self.logger.info(f"Unregister an instance not found=> {ins}\n")
+                ins.set_status(False)
+                return ins
+            self.logger.info(f"Unregister instance=> {ins}\n")
+            self.revision += 1
+            if self.store is not None:
+                self.store.append('unregister', ins, self.revision)
+            instances = self.proto2instances[proto]
+            # 按存储的实例（带方法表）清理索引，注销请求本身不一定携带参数
+            self.unindex_methods(instances[instances.index(ins)])
+            instances.remove(ins)
+            del self.ins2timestamp[ins]
             ins.set_status(False)
             return ins
-        self.logger.info(f"Unregister instance=> {ins}\n")
-        self.proto2instances[proto].remove(ins)
-        del self.ins2timestamp[ins]
-        ins.set_status(False)
-        return ins
+
+    @staticmethod
+    def method_names(ins: InstanceMeta) -> List[str]:
+        """服务实例注册时发布的方法名，未发布方法表（旧版本服务端）的返回空列表"""
+        return [method['method_name'] for method in ins.parameters.get('methods', [])]
+
+    def index_methods(self, ins: InstanceMeta):
+        """持锁调用：把服务实例加入其发布的各方法的倒排索引"""
+        for method_name in self.method_names(ins):
+            self.method2instances[method_name].append(ins)
+
+    def unindex_methods(self, ins: InstanceMeta):
+        """持锁调用：把服务实例从其发布的各方法的倒排索引中移除"""
+        for method_name in self.method_names(ins):
+            instances = self.method2instances[method_name]
+            if ins in instances:
+                instances.remove(ins)
+            if not instances:
+                del self.method2instances[method_name]
+
+    def replace_indexed(self, ins: InstanceMeta):
+        """持锁调用：参数未变的心跳只替换索引中的实例对象，使索引返回的实例与 proto2instances 中的一致"""
+        for method_name in self.method_names(ins):
+            instances = self.method2instances.get(method_name, [])
+            if ins in instances:
+                instances[instances.index(ins)] = ins
+
+    def find_instances_by_method(self, method_name: str, protocol="json") -> List[InstanceMeta]:
+        """根据方法名返回提供该方法且使用对应序列化消息格式的服务实例"""
+        with self.lock:
+            return [ins for ins in self.method2instances.get(method_name, []) if ins.protocol == protocol]
+
+    def all_instances(self) -> List[InstanceMeta]:
+        """返回所有序列化数据格式下的服务实例"""
+        with self.lock:
+            return [ins for instances in self.proto2instances.values() for ins in instances]
 
     def find_instances_by_protocol(self, protocol="json") -> List[InstanceMeta]:
         """根据序列化消息格式返回对应服务实例"""
-        return self.proto2instances[protocol]
+        with self.lock:
+            return list(self.proto2instances[protocol])
+
+    def find_instances_with_revision(self, protocol="json"):
+        """同 find_instances_by_protocol，同时返回与实例列表一致的修订号"""
+        with self.lock:
+            return list(self.proto2instances[protocol]), self.revision
 
     def handle_check_health(self):
         """对服务实例进行健康检测"""
@@ -147,19 +418,27 @@ class RegistryService:
             self.logger.info('Health check=> Instance list is empty\n')
         else:
             self.logger.info('Health check==================>')
+            in_grace = cur_time < self.grace_until  # 刚从持久化恢复，服务端可能还没来得及重新发心跳
             for ins, timestamp in list(self.ins2timestamp.items()):
-                if cur_time - timestamp > threshold:
+                if cur_time - timestamp > threshold and not in_grace:
                     self.logger.info(
                         f"!!!Instance {ins} is unhealthy, last seen at {datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')}")
-                    self.unregister(ins)
+                    self.unregister(ins, replicate=False)  # 各节点都收到复制的心跳，独立判断超时
                 else:
                     self.logger.info(
                         f"Instance {ins} is healthy, last seen at {datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')}")
 
     def stop(self):
-        """停止心跳检测线程"""
+        """停止心跳检测线程，有持久化时写一次快照，下次启动无需重放变更日志"""
         self._stop_event.set()  # 设置停止事件
         self._health_thread.join()  # 等待线程结束
+        if self.replicator is not None:
+            self.replicator.stop()
+        if self.store is not None:
+            # 与注册/注销的写入互斥，快照与修订号一致，且关闭变更日志后不再有追加
+            with self.lock:
+                self.store.compact(self.all_instances(), self.revision)
+                self.store.close()
 
     def loop_check_health(self):
         """定期健康检测，循环"""
@@ -167,6 +446,9 @@ class RegistryService:
         self.logger.info("健康检测已在后台开启")
         while not self._stop_event.is_set():
             self.handle_check_health()
+            if self.store is not None and self.store.need_compact():
+                with self.lock:
+                    self.store.compact(self.all_instances(), self.revision)
             self._stop_event.wait(5)  # 等待5秒或直到事件被设置
 
 
@@ -188,6 +470,8 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.handle_register(body)
         elif parsed_path.path == '/myRegistry/unregister':
             self.handle_unregister(body)
+        elif parsed_path.path == '/myRegistry/replicate':
+            self.handle_replicate(body)
         else:
             self.handle_404()
 
@@ -197,6 +481,10 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         if parsed_path.path == '/myRegistry/findAllInstances':
             self.handle_find_all_instances(query_params)
+        elif parsed_path.path == '/myRegistry/findInstancesByMethod':
+            self.handle_find_instances_by_method(query_params)
+        elif parsed_path.path == '/myRegistry/dump':
+            self.handle_dump()
         else:
             self.handle_404()
 
@@ -215,9 +503,30 @@ class RequestHandler(BaseHTTPRequestHandler):
     def handle_find_all_instances(self, query_params):
         """服务发现路由，根据序列化数据格式请求"""
         protocol = query_params.get('proto', [None])[0]
-        instances = self.registry_service.find_instances_by_protocol(protocol)
+        instances, revision = self.registry_service.find_instances_with_revision(protocol)
+        self.respond([instance.to_dict() for instance in instances], {'X-Registry-Revision': str(revision)})
+
+    def handle_find_instances_by_method(self, query_params):
+        """按方法的服务发现路由，只返回提供该方法的服务实例"""
+        protocol = query_params.get('proto', [None])[0]
+        method_name = query_params.get('method', [None])[0]
+        instances = self.registry_service.find_instances_by_method(method_name, protocol)
         self.respond([instance.to_dict() for instance in instances])
 
+    def handle_replicate(self, body):
+        """集群复制路由，应用对等节点转发来的一批变更"""
+        for change in body:
+            instance_meta = InstanceMeta.from_dict(change['instance'])
+            if change['op'] == 'register':
+                self.registry_service.register(instance_meta, replicate=False)
+            else:
+                self.registry_service.unregister(instance_meta, replicate=False)
+        self.respond({'applied': len(body)})
+
+    def handle_dump(self):
+        """集群同步路由，返回本节点全部服务实例"""
+        self.respond([instance.to_dict() for instance in self.registry_service.all_instances()])
+
     def handle_404(self):
         """无效路由处理"""
         self.send_response(404)
@@ -226,11 +535,13 @@ class RequestHandler(BaseHTTPRequestHandler):
         response = json.dumps({'error': 'Not Found'}).encode('utf-8')
         self.wfile.write(response)
 
-    def respond(self, data):
-        """respond函数"""
+    def respond(self, data, headers=None):
+        """respond函数，headers 为额外的响应头"""
         response = json.dumps(data).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
         self.end_headers()
         self.wfile.write(response)
 
@@ -297,11 +608,29 @@ if __name__ == '__main__':
                       help='注册中心监听的 IP 地址，同时支持 IPv4 和 IPv6，可以为空，默认监听所有 IP 地址')
     pars.add_argument('-p', '--port', type=int, required=True,
                       help='注册中心监听的端口号，不可为空')
+    pars.add_argument('-d', '--data-dir', type=str, default=None,
+                      help='服务实例列表的本地持久化目录，重启后从中恢复，默认 ./registry_data/<端口号>')
+    pars.add_argument('--no-persistence', action='store_true',
+                      help='关闭本地持久化，服务实例列表只保存在内存中')
+    pars.add_argument('--grace-period', type=int, default=15,
+                      help='从持久化恢复或从对等节点同步后不做心跳超时摘除的宽限期（秒），默认 15')
+    pars.add_argument('--peers', type=str, default='',
+                      help='集群模式下其余注册中心节点，逗号分隔的 host:port 列表，如 127.0.0.1:9998,127.0.0.1:9997')
     args = pars.parse_args()
 
     # 日志与注册中心服务实例创建
     logger = Logger()
-    rs = RegistryService(logger)
+    store = None
+    if not args.no_persistence:
+        store = RegistryStore(args.data_dir or os.path.join('registry_data', str(args.port)), logger)
+    replicator = None
+    if args.peers:
+        peers = []
+        for peer in args.peers.split(','):
+            peer_host, peer_port = peer.strip().rsplit(':', 1)
+            peers.append((peer_host.strip('[]'), int(peer_port)))
+        replicator = RegistryReplicator(peers, logger)
+    rs = RegistryService(logger, store, args.grace_period, replicator)
 
     # 启动注册中心
     run(host=args.host, port=args.port, registry_service=rs, logger=logger)
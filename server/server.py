@@ -1,15 +1,33 @@
 import argparse
+import base64
 import configparser
+import cProfile
 import http.client
 import inspect
 import json
+import marshal
 import math
 import os
+import pstats
+import random
+import select
+import signal
 import socket
+import struct
+import subprocess
+import sys
 import threading
 import time
+import tracemalloc
+import zlib
+from collections import defaultdict, deque
 from datetime import datetime
 
+try:
+    import lz4.frame as lz4_frame  # 可选依赖，安装后作为更快的压缩编解码器
+except ImportError:
+    lz4_frame = None
+
 
 class InstanceMeta:
     """服务实例注册与发现使用的数据结构"""
@@ -89,86 +107,984 @@ class Logger:
         self.log('ERROR', msg)
 
 
+class Compression:
+    """
+    帧级压缩编解码器表：编解码器名称用于在注册参数和请求信封中协商，编解码器 id 写入帧头。
+    zlib 为标准库始终可用；安装了 lz4 时优先使用更快的 lz4
+    """
+    CODECS = {'zlib': (1, zlib.compress, zlib.decompress)}  # name -> (codec id, compress, decompress)
+    if lz4_frame is not None:
+        CODECS['lz4'] = (2, lz4_frame.compress, lz4_frame.decompress)
+    PREFERENCE = ('lz4', 'zlib') if lz4_frame is not None else ('zlib',)  # 越靠前越优先
+    DECOMPRESSORS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+    @staticmethod
+    def negotiate(offered):
+        """从对端支持的编解码器列表中选出本端最优先的一个，没有共同支持的返回 None（不压缩）"""
+        if not offered:
+            return None
+        for name in Compression.PREFERENCE:
+            if name in offered:
+                return name
+        return None
+
+
+class Tracer:
+    """
+    分布式追踪：客户端按采样率为调用生成 trace/span id 随请求信封传播，客户端与服务端分别记录各阶段耗时，
+    结束的 span 以 Zipkin v2 JSON 格式（每行一个 span，阶段耗时记在 tags 中，单位微秒）写入本地文件，由后台线程批量落盘
+    """
+
+    def __init__(self, service_name, logger, flush_interval=1.0):
+        """
+        :param service_name: string span 中的服务名，也用作 span 文件名前缀
+        :param logger: 运行日志
+        :param flush_interval: float 后台线程落盘间隔（秒）
+        """
+        self.service_name = service_name
+        self.logger = logger
+        self.flush_interval = flush_interval
+        config = configparser.ConfigParser()
+        config.read('docket_test_config.ini')
+        self.sample_rate = config.getfloat('tracing', 'sample_rate', fallback=0.0)
+        spans_dir = config.get('tracing', 'spans_dir', fallback='traces')
+        self.spans_file = os.path.join(spans_dir, f'{service_name}-{os.getpid()}.jsonl')
+        self.pending = []  # 尚未落盘的 span
+        self.lock = threading.Lock()
+        self.flush_thread = None
+
+    def start_trace(self):
+        """按采样率决定是否追踪本次调用：采样时返回随请求发送的追踪上下文，否则返回 None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return {'trace_id': f'{random.getrandbits(128):032x}', 'span_id': f'{random.getrandbits(64):016x}',
+                'sampled': True}
+
+    def record(self, trace, name, kind, start, duration, stages, remote=None, tags=None, span_id=None,
+               parent_id=None):
+        """
+        记录一个结束的 span
+        :param trace: dict 追踪上下文，提供 trace_id
+        :param kind: string 'CLIENT' / 'SERVER'
+        :param start: float span 开始的时间（time.time()）
+        :param duration: float span 耗时（秒）
+        :param stages: dict 阶段名 -> 耗时（秒）
+        :param remote: (host, port) 对端地址
+        :param tags: dict 其余标签
+        :param span_id: string 为空则使用追踪上下文中的 span_id
+        :param parent_id: string 父 span id
+        """
+        span = {'traceId': trace['trace_id'], 'id': span_id or trace['span_id'], 'name': name, 'kind': kind,
+                'timestamp': int(start * 1e6), 'duration': max(1, int(duration * 1e6)),
+                'localEndpoint': {'serviceName': self.service_name}}
+        if parent_id is not None:
+            span['parentId'] = parent_id
+        if remote is not None and not str(remote[0]).startswith('unix:'):
+            host, port = remote[0], remote[1]
+            span['remoteEndpoint'] = {'ipv6' if ':' in host else 'ipv4': host, 'port': port}
+        span_tags = {f'stage.{stage}_us': str(int(seconds * 1e6)) for stage, seconds in stages.items()}
+        span_tags.update({key: str(value) for key, value in (tags or {}).items()})
+        span['tags'] = span_tags
+        with self.lock:
+            self.pending.append(span)
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(target=self.loop_flush, daemon=True)
+                self.flush_thread.start()
+
+    def loop_flush(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """把积攒的 span 追加写入 span 文件"""
+        with self.lock:
+            spans, self.pending = self.pending, []
+        if not spans:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.spans_file) or '.', exist_ok=True)
+            with open(self.spans_file, 'a') as f:
+                f.write(''.join(json.dumps(span) + '\n' for span in spans))
+        except OSError as e:
+            self.logger.error(f"写入 span 文件 {self.spans_file} 失败：{e}")
+
+
+class CompressionMetrics:
+    """帧压缩统计：分压缩/解压两个方向记录帧数、原始字节数、线上字节数与 CPU 耗时"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {'compress': [0, 0, 0, 0.0], 'decompress': [0, 0, 0, 0.0]}
+
+    def record(self, direction, raw_size, wire_size, cpu_time):
+        with self.lock:
+            stat = self.stats[direction]
+            stat[0] += 1
+            stat[1] += raw_size
+            stat[2] += wire_size
+            stat[3] += cpu_time
+
+    def snapshot(self):
+        """返回各方向的统计，ratio 为原始字节数/线上字节数"""
+        with self.lock:
+            return {direction: {'frames': frames,
+                                'raw_bytes': raw,
+                                'wire_bytes': wire,
+                                'ratio': round(raw / wire, 2) if wire else None,
+                                'cpu_ms': round(cpu * 1000, 3)}
+                    for direction, (frames, raw, wire, cpu) in self.stats.items()}
+
+
+class FrameTooLarge(ValueError):
+    """消息体超过单帧上限，长度头放不下，不能发送"""
+    pass
+
+
+class FrameProtocol:
+    """
+    TCP 消息分帧：每帧为 4 字节大端无符号长度头 + 消息体。
+    解决单次 recv(1024) 收不全大消息、多条消息粘连的问题，也是流式回复逐帧发送的基础
+    """
+    HEADER = struct.Struct('!I')
+    CODEC_SHIFT = 28  # 长度头高 4 位记录压缩编解码器 id（0 为未压缩），低 28 位为消息体长度
+    LENGTH_MASK = (1 << CODEC_SHIFT) - 1
+    MAX_FRAME_SIZE = 64 * 1024 * 1024  # 单帧上限，防止异常长度头导致一次性申请过大内存
+    # 旧版客户端不分帧，直接发送 json 请求；'{' 作为长度头首字节对应编解码器 id 7，未被使用，据此区分两种格式
+    LEGACY_PREFIX = b'{'
+
+    @staticmethod
+    def pack(payload, codec=None, threshold=0, metrics=None):
+        """
+        打包一帧；指定 codec 且消息体不小于 threshold 时压缩，压缩后反而变大则原样发送
+        :param payload: bytes 消息体
+        :param codec: string 与对端协商出的编解码器名称，None 表示不压缩
+        :param threshold: int 压缩阈值（字节）
+        :param metrics: CompressionMetrics 压缩统计，可为空
+        """
+        codec_id = 0
+        if codec is not None and len(payload) >= threshold:
+            cid, compress, _ = Compression.CODECS[codec]
+            start = time.thread_time()
+            compressed = compress(payload)
+            if metrics is not None:
+                metrics.record('compress', len(payload), min(len(compressed), len(payload)),
+                               time.thread_time() - start)
+            if len(compressed) < len(payload):
+                payload, codec_id = compressed, cid
+        if len(payload) > FrameProtocol.MAX_FRAME_SIZE:
+            # 长度超过低 28 位会溢出到编解码器 id 所在的高 4 位，对端将读错帧边界，只能拒绝发送
+            raise FrameTooLarge(f"frame too large: {len(payload)} bytes, limit {FrameProtocol.MAX_FRAME_SIZE} bytes")
+        return FrameProtocol.HEADER.pack(codec_id << FrameProtocol.CODEC_SHIFT | len(payload)) + payload
+
+    @staticmethod
+    def recv_exact(sock, length):
+        """从 sock 中收满 length 个字节；连接在帧开始前关闭抛 EOFError，帧传输中途关闭抛 ConnectionError"""
+        buf = bytearray()
+        while len(buf) < length:
+            chunk = sock.recv(length - len(buf))
+            if not chunk:
+                if not buf:
+                    raise EOFError()
+                raise ConnectionError("connection closed in the middle of a frame")
+            buf += chunk
+        return bytes(buf)
+
+    @staticmethod
+    def recv(sock, metrics=None):
+        """接收一整帧，返回（必要时解压后的）消息体"""
+        (value,) = FrameProtocol.HEADER.unpack(FrameProtocol.recv_exact(sock, FrameProtocol.HEADER.size))
+        codec_id, length = value >> FrameProtocol.CODEC_SHIFT, value & FrameProtocol.LENGTH_MASK
+        if length > FrameProtocol.MAX_FRAME_SIZE:
+            raise ConnectionError(f"frame too large: {length} bytes")
+        payload = FrameProtocol.recv_exact(sock, length) if length else b''
+        if codec_id:
+            start = time.thread_time()
+            raw = Compression.DECOMPRESSORS[codec_id](payload)
+            if metrics is not None:
+                metrics.record('decompress', len(raw), len(payload), time.thread_time() - start)
+            payload = raw
+        return payload
+
+    @staticmethod
+    def is_legacy(sock):
+        """窥探下一条消息的首字节，判断是否为旧版客户端不分帧的 json 请求；连接已关闭抛 EOFError"""
+        head = sock.recv(1, socket.MSG_PEEK)
+        if not head:
+            raise EOFError()
+        return head == FrameProtocol.LEGACY_PREFIX
+
+    @staticmethod
+    def recv_legacy(sock):
+        """接收一条旧版不分帧的 json 请求：持续读取，直到已收到的字节构成完整的 json 文档"""
+        buf = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                if not buf:
+                    raise EOFError()
+                raise ConnectionError("connection closed in the middle of a legacy request")
+            buf += chunk
+            try:
+                json.loads(buf)
+                return bytes(buf)
+            except ValueError:
+                if len(buf) > FrameProtocol.MAX_FRAME_SIZE:
+                    raise ConnectionError(f"legacy request too large: {len(buf)} bytes")
+
+
+class DeadlineExceeded(Exception):
+    """调用方给出的时间预算已耗尽"""
+    pass
+
+
+class CallContext:
+    """
+    当前处理线程正在执行的调用的上下文，调用执行期间绑定在线程局部变量上。
+    注册方法可通过 CallContext.remaining() 获取调用方剩余的时间预算，通过 CallContext.check_deadline() 在预算耗尽时提前放弃
+    """
+    _local = threading.local()
+
+    def __init__(self, method_name, deadline=None):
+        """
+        :param method_name: string 调用的方法名
+        :param deadline: float 以 time.monotonic() 计的截止时间，为空表示调用方未设置超时
+        """
+        self.method_name = method_name
+        self.deadline = deadline
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(CallContext._local, 'context', None)
+        CallContext._local.context = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        CallContext._local.context = self.previous
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @staticmethod
+    def current():
+        """返回当前线程正在执行的调用的上下文，不在调用中返回 None"""
+        return getattr(CallContext._local, 'context', None)
+
+    @staticmethod
+    def remaining():
+        """返回当前调用剩余的时间预算（秒），调用方未设置超时或不在调用中返回 None"""
+        context = CallContext.current()
+        if context is None or context.deadline is None:
+            return None
+        return max(0.0, context.deadline - time.monotonic())
+
+    @staticmethod
+    def check_deadline():
+        """当前调用的时间预算已耗尽时抛出 DeadlineExceeded"""
+        context = CallContext.current()
+        if context is not None and context.expired():
+            raise DeadlineExceeded(f"deadline of {context.method_name} exceeded")
+
+
+class ServerOverloaded(Exception):
+    """服务端饱和，请求被准入控制拒绝或在排队中被挤出"""
+    pass
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 自适应并发上限：按方法维护执行耗时（取对数，即几何平均，不受个别极慢样本左右）的短期平均与基线，
+    并发接近上限时短期平均连续多次高于基线的 tolerance 倍，说明请求开始互相拖慢、已过饱和，乘性减小上限；
+    否则加性增加上限。比较的是平滑后的耗时而不是单次采样与历史最小值，正常的耗时抖动不会被误判为过载；
+    按方法区分，避免把天生慢的方法误判为过载。
+    基线只由不拥挤时的样本决定：并发接近上限时的耗时可能已被过载抬高，基线哪怕缓慢跟随，持续过载下也终将追上，
+    上限随之一路增长。方法本身变慢时上限会一直减到 min_limit，此时的样本不再受并发影响，基线据此重新校准
+    """
+
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=64, tolerance=1.5, backoff=0.9,
+                 short_alpha=0.05, long_alpha=0.01, patience=5, warmup=20):
+        """
+        :param tolerance: float 短期平均耗时超过基线的多少倍视为过载
+        :param backoff: float 过载时上限乘以的系数
+        :param short_alpha: float 短期滑动平均的平滑系数，约反映最近 1/short_alpha 次执行
+        :param long_alpha: float 基线（不拥挤时耗时的滑动平均）的平滑系数；启动时即已饱和的方法
+                           以热身期间（初始上限下）的平均耗时为基线
+        :param patience: int 连续多少个样本过载才减小上限
+        :param warmup: int 方法的样本数达到此值之前只更新平均值，不调整上限
+        """
+        self.limit = float(min(initial_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = math.log(tolerance)
+        self.backoff = backoff
+        self.short_alpha = short_alpha
+        self.long_alpha = long_alpha
+        self.patience = patience
+        self.warmup = warmup
+        self.stats = {}  # method_name -> [样本数, 短期平均对数耗时, 基线对数耗时, 连续过载样本数]
+        self.last_decrease = 0.0
+
+    def current(self):
+        return int(self.limit)
+
+    def on_sample(self, method_name, latency, inflight):
+        """
+        记录一次执行耗时并调整上限，由调度器持锁调用
+        :param method_name: string 方法名
+        :param latency: float 执行耗时（秒），不含排队时间
+        :param inflight: int 采样时正在执行的请求数（含本请求）
+        """
+        x = math.log(max(latency, 1e-6))
+        stats = self.stats.get(method_name)
+        if stats is None:
+            stats = self.stats[method_name] = [0, x, x, 0]
+        stats[0] += 1
+        loaded = inflight >= self.limit / 2
+        # 前若干个样本按算术平均累计，避免平均值被第一个样本带偏
+        stats[1] += max(self.short_alpha, 1 / stats[0]) * (x - stats[1])
+        # 热身期间上限不变，样本耗时不会随上限增长而升高，可计入基线；此后只计入不拥挤时的样本
+        if stats[0] <= self.warmup or not loaded or inflight <= self.min_limit:
+            stats[2] += max(self.long_alpha, 1 / stats[0]) * (x - stats[2])
+        count, short, long = stats[:3]
+        if count < self.warmup or not loaded:
+            # 并发远低于上限时耗时变化与上限无关，既不加也不减，避免空闲时上限无限增长或被抖动压低
+            return
+        if short - long > self.tolerance:
+            stats[3] += 1
+            # 持续过载才减；同一波拥塞只减一次，间隔至少一个基线耗时
+            now = time.monotonic()
+            if stats[3] >= self.patience and now - self.last_decrease > max(math.exp(long), 0.01):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+        else:
+            stats[3] = 0
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class PriorityScheduler:
+    """
+    位于方法执行之前的分优先级准入与调度：
+    并发数未达自适应上限时请求直接执行，否则按优先级进入各自的队列，
+    有空位时按平滑加权轮询（smooth weighted round robin）从各队列取出请求执行，
+    队列满时优先挤掉低优先级请求
+    """
+    WEIGHTS = {'interactive': 8, 'normal': 4, 'batch': 1}  # 优先级 -> 调度权重，也是由高到低的优先顺序
+    DEFAULT_PRIORITY = 'normal'
+
+    class Ticket:
+        """一个等待执行的请求"""
+
+        def __init__(self, priority, method_name):
+            self.priority = priority
+            self.method_name = method_name
+            self.event = threading.Event()
+            self.granted = False
+            self.shed = False
+            self.start = None
+
+    def __init__(self, logger, limiter=None, max_queue=256):
+        """
+        :param logger: 运行日志
+        :param limiter: AdaptiveLimiter 并发上限，为空使用默认参数创建
+        :param max_queue: int 所有优先级队列合计的最大排队请求数
+        """
+        self.logger = logger
+        self.limiter = limiter or AdaptiveLimiter()
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.queues = {priority: deque() for priority in self.WEIGHTS}
+        self.current_weights = {priority: 0 for priority in self.WEIGHTS}
+        self.inflight = 0
+        self.shed_count = {priority: 0 for priority in self.WEIGHTS}
+
+    def normalize(self, priority):
+        return priority if priority in self.WEIGHTS else self.DEFAULT_PRIORITY
+
+    def acquire(self, priority, method_name, deadline=None):
+        """
+        申请执行名额，必要时排队等待
+        :param priority: string 请求优先级
+        :param method_name: string 方法名，调整并发上限需要
+        :param deadline: float 以 time.monotonic() 计的截止时间，排队超过截止时间即放弃
+        :return: Ticket 获得执行名额的请求，执行完需调用 release
+        """
+        ticket = PriorityScheduler.Ticket(self.normalize(priority), method_name)
+        with self.lock:
+            queued = sum(len(queue) for queue in self.queues.values())
+            if queued == 0 and self.inflight < self.limiter.current():
+                self.grant(ticket)
+                return ticket
+            if queued >= self.max_queue and not self.shed_lower_than(ticket.priority):
+                self.shed_count[ticket.priority] += 1
+                raise ServerOverloaded(f"queue is full ({queued} waiting), {ticket.priority} request rejected")
+            self.queues[ticket.priority].append(ticket)
+            self.dispatch()
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        ticket.event.wait(timeout)
+        with self.lock:
+            if not ticket.granted and not ticket.shed:
+                self.queues[ticket.priority].remove(ticket)
+                raise DeadlineExceeded(f"request expired after queueing {timeout:.3f}s")
+        if ticket.shed:
+            raise ServerOverloaded(f"{ticket.priority} request shed in favor of higher priority traffic")
+        return ticket
+
+    def release(self, ticket):
+        """执行完毕，归还名额并按执行耗时调整并发上限，再从队列中调度新的请求"""
+        with self.lock:
+            self.limiter.on_sample(ticket.method_name, time.monotonic() - ticket.start, self.inflight)
+            self.inflight -= 1
+            self.dispatch()
+
+    def grant(self, ticket):
+        """持锁调用：给请求执行名额"""
+        self.inflight += 1
+        ticket.granted = True
+        ticket.start = time.monotonic()
+        ticket.event.set()
+
+    def dispatch(self):
+        """持锁调用：在并发上限内按平滑加权轮询从非空队列中取请求执行"""
+        while self.inflight < self.limiter.current():
+            candidates = [priority for priority, queue in self.queues.items() if queue]
+            if not candidates:
+                return
+            total = sum(self.WEIGHTS[priority] for priority in candidates)
+            for priority in candidates:
+                self.current_weights[priority] += self.WEIGHTS[priority]
+            chosen = max(candidates, key=lambda priority: self.current_weights[priority])
+            self.current_weights[chosen] -= total
+            self.grant(self.queues[chosen].popleft())
+
+    def shed_lower_than(self, priority):
+        """持锁调用：队列满时挤掉一个比 priority 低的、最晚入队的请求，没有可挤掉的返回 False"""
+        order = list(self.WEIGHTS)
+        for lower in reversed(order[order.index(priority) + 1:]):
+            if self.queues[lower]:
+                victim = self.queues[lower].pop()
+                victim.shed = True
+                victim.event.set()
+                self.shed_count[lower] += 1
+                return True
+        return False
+
+    def snapshot(self):
+        with self.lock:
+            return {'limit': self.limiter.current(),
+                    'inflight': self.inflight,
+                    'queued': {priority: len(queue) for priority, queue in self.queues.items()},
+                    'shed': dict(self.shed_count)}
+
+
+class RequestProfiler:
+    """
+    线上按需剖析，由保留的管理方法 your_profile_start / your_profile_stop 控制，到时自动停止，无需重启服务端：
+    cprofile 模式为每个请求的方法执行单独启用 cProfile（只覆盖方法本身，不含网络收发与排队），结束时合并统计；
+    sampling 模式由后台线程定期采样正在执行请求的线程的调用栈，开销固定，不随请求量增长；
+    两种模式都按方法统计调用次数、CPU 时间（thread_time）与墙钟时间；memory=True 时另用 tracemalloc 统计剖析期间新增、
+    到剖析结束时仍未释放的内存（留存内存，可用于发现泄漏与缓存增长）。tracemalloc 只跟踪存活的内存块且是进程级的，
+    并发请求之间无法区分，因此不统计每次调用的分配次数。
+    Python 3.12 起 cProfile 基于进程级的 sys.monitoring，启用后覆盖所有线程且同一时刻只能启用一个，
+    无法再为并发执行的请求分别剖析，此时 cprofile 模式改为 sampling 模式，并在报告中注明
+    """
+    MODES = ('cprofile', 'sampling')
+    MAX_SECONDS = 600  # 单次剖析的最长时间，避免忘记停止导致剖析开销一直存在
+    PER_REQUEST_CPROFILE = sys.version_info < (3, 12)  # 能否为每个请求单独启用 cProfile
+
+    def __init__(self, logger, services):
+        """
+        :param logger: 运行日志
+        :param services: dict 方法名 -> 函数，即 ServerStub.services，留存内存按分配时调用栈中的代码位置归属到各方法
+        """
+        self.logger = logger
+        self.services = services
+        self.lock = threading.Lock()
+        self.active = False
+        self.session = 0  # 每次开始剖析加一，结束后才完成的请求不计入已结束的剖析
+        self.mode = None
+        self.note = None  # 实际剖析方式与请求的不同时的说明
+        self.started_at = None
+        self.stopped_at = None
+        self.timer = None
+        self.sampler = None
+        self.interval = 0.005
+        self.executing = {}  # 正在执行请求的线程 id -> 方法名，采样时只看这些线程
+        self.method_stats = {}  # 方法名 -> {'calls', 'cpu', 'wall'}
+        self.stats = None  # 合并后的 pstats.Stats
+        self.samples = 0
+        self.self_samples = defaultdict(int)  # (文件, 行号, 函数名) -> 位于栈顶的采样次数
+        self.total_samples = defaultdict(int)  # (文件, 行号, 函数名) -> 出现在栈中的采样次数
+        self.memory = False
+        self.started_tracemalloc = False
+        self.snapshot = None
+        self.start_snapshot = None
+
+    def start(self, mode='cprofile', seconds=30, memory=False, interval_ms=5):
+        """
+        开始剖析
+        :param mode: string 'cprofile' 或 'sampling'
+        :param seconds: float 剖析时长（秒），到时自动停止，最长 MAX_SECONDS
+        :param memory: bool 是否同时用 tracemalloc 统计留存内存（有额外开销）
+        :param interval_ms: float sampling 模式的采样间隔（毫秒）
+        :return: dict 剖析状态
+        """
+        if mode not in self.MODES:
+            raise TypeError(f"mode must be one of {self.MODES}")
+        seconds = min(float(seconds), self.MAX_SECONDS)
+        note = None
+        if mode == 'cprofile' and not self.PER_REQUEST_CPROFILE:
+            note = (f"cprofile mode is unavailable on Python {sys.version_info[0]}.{sys.version_info[1]} "
+                    f"(cProfile covers all threads and allows one active profiler), sampled instead")
+            mode = 'sampling'
+        with self.lock:
+            if self.active:
+                raise RuntimeError(f"a {self.mode} profile is already running")
+            self.active = True
+            self.session += 1
+            self.mode = mode
+            self.note = note
+            self.started_at, self.stopped_at = time.time(), None
+            self.method_stats = {}
+            self.stats = None
+            self.samples = 0
+            self.self_samples = defaultdict(int)
+            self.total_samples = defaultdict(int)
+            self.memory = memory
+            self.snapshot = None
+            self.start_snapshot = None
+            self.started_tracemalloc = memory and not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start(16)  # 保留足够的栈帧，才能把分配归属到注册方法
+            if memory:
+                # 结束时与此快照比较，只统计剖析期间的增长，不含 tracemalloc 此前已在跟踪的内存
+                self.start_snapshot = tracemalloc.take_snapshot()
+            if mode == 'sampling':
+                self.interval = interval_ms / 1000
+                self.sampler = threading.Thread(target=self.loop_sample, args=(self.session,), daemon=True)
+                self.sampler.start()
+            self.timer = threading.Timer(seconds, self.finish, args=(self.session,))
+            self.timer.daemon = True
+            self.timer.start()
+        self.logger.info(f"Started {mode} profile for {seconds}s{' with tracemalloc' if memory else ''}")
+        status = {'mode': mode, 'seconds': seconds, 'memory': memory}
+        if note is not None:
+            status['note'] = note
+        return status
+
+    def finish(self, session=None):
+        """结束剖析（到时自动结束或被 stop 调用），保留剖析数据供 report 使用"""
+        with self.lock:
+            if not self.active or (session is not None and session != self.session):
+                return
+            self.active = False
+            self.stopped_at = time.time()
+            self.timer.cancel()
+            if self.memory and tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+                if self.started_tracemalloc:
+                    tracemalloc.stop()
+        self.logger.info(f"Finished {self.mode} profile")
+
+    def stop(self, top=30, dump=False):
+        """
+        结束剖析（若仍在进行）并返回报告
+        :param top: int 报告中列出的函数 / 分配位置个数
+        :param dump: bool 是否附带 base64 编码的 pstats 数据（cprofile 模式），解码写入文件后可用 pstats.Stats 加载
+        """
+        if self.started_at is None:
+            raise RuntimeError("no profile has been started")
+        self.finish()
+        return self.report(top, dump)
+
+    def run(self, method_name, method, args, kwargs):
+        """执行一次注册方法；剖析进行中时记录该次执行的剖析数据"""
+        if not self.active:
+            return method(*args, **kwargs)
+        session = self.session
+        ident = threading.get_ident()
+        profile = cProfile.Profile() if self.mode == 'cprofile' else None
+        self.executing[ident] = method_name
+        cpu, wall = time.thread_time(), time.monotonic()
+        try:
+            if profile is not None:
+                try:
+                    profile.enable()
+                except ValueError:
+                    profile = None  # 其他剖析器正在运行（新版本 Python 同一时刻只允许一个），本次不剖析
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            cpu, wall = time.thread_time() - cpu, time.monotonic() - wall
+            self.executing.pop(ident, None)
+            with self.lock:
+                if session == self.session and self.stopped_at is None:
+                    stats = self.method_stats.setdefault(method_name, {'calls': 0, 'cpu': 0.0, 'wall': 0.0})
+                    stats['calls'] += 1
+                    stats['cpu'] += cpu
+                    stats['wall'] += wall
+                    if profile is not None:
+                        try:
+                            if self.stats is None:
+                                self.stats = pstats.Stats(profile)
+                            else:
+                                self.stats.add(profile)
+                        except TypeError:
+                            pass  # 没有采集到任何调用
+
+    def loop_sample(self, session):
+        """采样线程：每隔 interval 记录一次各请求执行线程的调用栈，栈只记录到 run 为止（不含服务端框架代码）"""
+        own_code = RequestProfiler.run.__code__
+        while self.active and session == self.session:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident in list(self.executing):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    self.samples += 1
+                    seen = set()
+                    leaf = True
+                    while frame is not None and frame.f_code is not own_code:
+                        code = frame.f_code
+                        key = (code.co_filename, code.co_firstlineno, code.co_name)
+                        if leaf:
+                            self.self_samples[key] += 1
+                            leaf = False
+                        if key not in seen:
+                            seen.add(key)
+                            self.total_samples[key] += 1
+                        frame = frame.f_back
+
+    def report(self, top=30, dump=False):
+        """按方法汇总以及 cProfile / 采样 / 留存内存的前 top 项"""
+        with self.lock:
+            end = self.stopped_at or time.time()
+            result = {'mode': self.mode, 'duration': round(end - self.started_at, 3), 'running': self.active,
+                      'methods': {name: {'calls': stats['calls'], 'cpu_ms': round(stats['cpu'] * 1000, 3),
+                                         'wall_ms': round(stats['wall'] * 1000, 3)}
+                                  for name, stats in self.method_stats.items()}}
+            if self.note is not None:
+                result['note'] = self.note
+            if self.mode == 'cprofile' and self.stats is not None:
+                rows = sorted(self.stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+                result['top'] = [{'function': f"{file}:{line}({func})", 'calls': nc, 'primitive_calls': cc,
+                                  'self_ms': round(tt * 1000, 3), 'cumulative_ms': round(ct * 1000, 3)}
+                                 for (file, line, func), (cc, nc, tt, ct, _) in rows]
+                if dump:
+                    result['pstats'] = base64.b64encode(marshal.dumps(self.stats.stats)).decode('ascii')
+            elif self.mode == 'sampling':
+                rows = sorted(self.total_samples.items(), key=lambda item: item[1], reverse=True)[:top]
+                result['samples'] = self.samples
+                result['top'] = [{'function': f"{file}:{line}({func})",
+                                  'total_pct': round(100 * count / self.samples, 1),
+                                  'self_pct': round(100 * self.self_samples.get((file, line, func), 0) / self.samples, 1)}
+                                 for (file, line, func), count in rows]
+            snapshot, start_snapshot = self.snapshot, self.start_snapshot
+        if snapshot is not None:
+            growth = [stat for stat in snapshot.compare_to(start_snapshot, 'lineno') if stat.size_diff > 0]
+            result['retained'] = [{'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                                   'blocks': stat.count_diff, 'kb': round(stat.size_diff / 1024, 1)}
+                                  for stat in growth[:top]]
+            for name, retained in self.attribute_retained(snapshot, start_snapshot).items():
+                result['methods'].setdefault(name, {}).update(retained)
+        return result
+
+    def attribute_retained(self, snapshot, start_snapshot):
+        """
+        把剖析期间新增、结束时仍存活的内存按分配时的调用栈归属到注册方法（栈中经过该方法的代码即计入）；
+        这是留存内存而不是分配量，调用中分配后又释放的内存不计入
+        :return: dict 方法名 -> {'retained_blocks', 'retained_kb'}
+        """
+        ranges = {}
+        for name, method in list(self.services.items()):
+            code = getattr(method, '__code__', None)
+            if code is None:
+                continue
+            try:
+                lines, first = inspect.getsourcelines(method)
+            except (OSError, TypeError):
+                continue
+            ranges[name] = (code.co_filename, first, first + len(lines))
+        allocations = {}
+        for stat in snapshot.compare_to(start_snapshot, 'traceback'):
+            if stat.size_diff <= 0:
+                continue
+            for name, (filename, first, last) in ranges.items():
+                if any(frame.filename == filename and first <= frame.lineno < last for frame in stat.traceback):
+                    blocks, size = allocations.get(name, (0, 0))
+                    allocations[name] = (blocks + stat.count_diff, size + stat.size_diff)
+        return {name: {'retained_blocks': blocks, 'retained_kb': round(size / 1024, 1)}
+                for name, (blocks, size) in allocations.items()}
+
+
 class ServerStub:
-    def __init__(self, logger):
+    STREAM_WINDOW = 16  # 流式回复的流控窗口：服务端最多领先客户端已消费进度这么多帧
+
+    def __init__(self, logger, compress_threshold=1024, scheduler=None, tracer=None, profiling=True):
+        """
+        :param logger: 运行日志
+        :param compress_threshold: int 回复帧压缩阈值（字节），None 表示不压缩回复也不对外声明支持压缩
+        :param scheduler: PriorityScheduler 方法执行前的准入与调度，为空使用默认参数创建
+        :param tracer: Tracer 为客户端采样的请求记录服务端各阶段耗时，为空不记录
+        :param profiling: bool 是否提供 your_profile_start / your_profile_stop 管理方法，供线上按需剖析
+        """
         self.services = {}
+        self.idempotent_methods = set()
         self.logger = logger
-
-    def register_services(self, method, name=None):
+        self.scheduler = scheduler or PriorityScheduler(logger)
+        self.compress_threshold = compress_threshold
+        self.compression_metrics = CompressionMetrics()
+        self.tracer = tracer
+        self.profiler = RequestProfiler(logger, self.services) if profiling else None
+
+    def compression_parameters(self):
+        """注册到注册中心的压缩协商参数，客户端据此决定请求帧的压缩编解码器与阈值"""
+        if self.compress_threshold is None:
+            return {}
+        return {'compression': list(Compression.PREFERENCE), 'compress_threshold': self.compress_threshold}
+
+    def register_services(self, method, name=None, idempotent=False):
         """
         处理方法注册，把注册的方法以方法名为键，函数为值（python中的函数是第一类对象（first-class
         objects），可以像其他对象一样被传递、赋值、存储在如列表、字典等数据结构中）的方式存于成员变量services中
         :param method: function 要注册的方法
         :param name: string 要注册方法的名称，为空则默认为注册方法函数名
+        :param idempotent: bool 方法是否幂等（重复执行无副作用），随方法表发布，客户端只对幂等方法发送对冲请求
         """
         if name is None:
             name = method.__name__
         self.services[name] = method
+        if idempotent:
+            self.idempotent_methods.add(name)
+        else:
+            self.idempotent_methods.discard(name)
         self.logger.info(f"注册方法：{name}")
 
-    def call_method(self, req, client_addr):
+    def method_table(self):
+        """
+        所有注册的方法名和参数格式，既用于响应 all_your_methods，也随注册发布到注册中心供按方法路由；
+        params 按签名顺序列出每个参数的名称、种类（inspect.Parameter 的 kind 名称，如 KEYWORD_ONLY、VAR_POSITIONAL）
+        与默认值，客户端据此生成与服务端一致的签名。
+        bytes、自定义对象等无法 json 序列化的默认值不发布（params 中只标记 has_default，method_kwargs 中记为 None），
+        否则整个方法表无法序列化，注册与 all_your_methods 都会失败
+        """
+        res = []
+        for method_name, method in self.services.items():
+            # 获取方法的签名
+            sig = inspect.signature(method)
+            params = sig.parameters
+            # 构造方法信息字典，包括方法名、必需参数和可选参数
+            method_info = {
+                "method_name": method_name,
+                "method_args": [param.name for param in params.values() if param.default is param.empty],
+                "method_kwargs": {param.name: param.default if self.is_json_safe(param.default) else None
+                                  for param in params.values() if param.default is not param.empty},
+                "params": [self.describe_parameter(param) for param in params.values()],
+                "idempotent": method_name in self.idempotent_methods
+            }
+            res.append(method_info)
+        return res
+
+    @staticmethod
+    def describe_parameter(param):
+        """方法表中一个参数的描述：名称、种类，有默认值时标记 has_default，默认值可 json 序列化时一并给出"""
+        info = {"name": param.name, "kind": param.kind.name}
+        if param.default is not param.empty:
+            info["has_default"] = True
+            if ServerStub.is_json_safe(param.default):
+                info["default"] = param.default
+        return info
+
+    @staticmethod
+    def is_json_safe(value):
+        """value 能否编码为 json"""
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def call_method(self, req, client_addr, legacy=False):
         """
         处理方法的调用，解析请求，从 services 中寻找请求的注册方法，返回调用成功或失败的回复消息
         :param req: 以json格式序列化后的请求方法调用消息
         :param client_addr: 调用方的 ip 地址，运行日志记录需要
-        :return: reply: 序列化后的调用结果信息（调用成功/调用不存在方法/调用方法参数错误/其余方法处理时发生错误）
+        :param legacy: bool 请求来自不分帧的旧版客户端：回复为不分帧、不压缩的 json，流式结果收齐为列表后一次性回复
+        :return: reply: 打包成帧的调用结果信息（调用成功/调用不存在方法/调用方法参数错误/调用方时间预算已耗尽/其余方法处理时发生错误）；
+                 若注册方法返回生成器，则返回逐个产出流式回复帧的生成器，由连接处理线程负责发送与流控
         """
-
+        arrival = time.monotonic()
+        arrival_wall = time.time()
+        codec = None
+        error = None
+        method_name = None
+        trace = None
+        # 客户端采样的请求记录各阶段耗时：decode 解析请求、queue 排队等待执行名额、execute 执行、serialize 序列化回复
+        stages = {}
         try:
             # 解码并解析请求数据
             req_data = json.loads(req.decode('utf-8'))
-            self.logger.info(f"来自客户端{str(client_addr)}的请求数据{req_data}")
+            stages['decode'] = time.monotonic() - arrival
+            if self.tracer is not None and (req_data.get('trace') or {}).get('sampled'):
+                trace = req_data['trace']
+            if req_data.get('method_name') != 'your_ping':  # 客户端定时健康探测，不逐条记录
+                self.logger.info(f"来自客户端{str(client_addr)}的请求数据{req_data}")
+
+            # 客户端在请求中声明可接受的压缩编解码器，未声明（旧客户端）则回复不压缩
+            if self.compress_threshold is not None:
+                codec = Compression.negotiate(req_data.get('accept_encoding'))
 
             # 从请求数据中提取方法名、方法参数和方法关键字参数
             method_name = req_data['method_name']
             method_args = req_data['method_args']
             method_kwargs = req_data['method_kwargs']
 
+            # 客户端在请求中带上剩余的时间预算（秒），换算为本地截止时间
+            timeout = req_data.get('timeout')
+            context = CallContext(method_name, arrival + timeout if timeout is not None else None)
+
+            # 响应健康探测：不经过调度，能回复即说明进程存活且仍在处理连接
+            if method_name == 'your_ping':
+                res = 'pong'
             # 响应服务发现
-            if method_name == 'all_your_methods':
+            elif method_name == 'all_your_methods':
                 # 返回所有注册的方法名和参数格式
-                res = []
-                for method_name, method in self.services.items():
-                    # 获取方法的签名
-                    sig = inspect.signature(method)
-                    params = sig.parameters
-                    # 构造方法信息字典，包括方法名、必需参数和可选参数
-                    method_info = {
-                        "method_name": method_name,
-                        "method_args": [param.name for param in params.values() if param.default == param.empty],
-                        "method_kwargs": {param.name: param.default for param in params.values() if
-                                          param.default != param.empty}
-                    }
-                    res.append(method_info)
+                res = self.method_table()
+            elif method_name == 'your_metrics':
+                # 返回运行指标
+                res = {'compression': self.compression_metrics.snapshot(),
+                       'scheduler': self.scheduler.snapshot()}
+            elif method_name in ('your_profile_start', 'your_profile_stop') and self.profiler is not None:
+                # 管理方法：开始限时剖析 / 结束剖析并返回报告
+                if method_name == 'your_profile_start':
+                    res = self.profiler.start(*method_args, **method_kwargs)
+                else:
+                    res = self.profiler.stop(*method_args, **method_kwargs)
             else:
-                # 响应服务调用
-                res = self.services[method_name](*method_args, **method_kwargs)
+                # 调用方已经放弃等待的请求直接丢弃，不再执行
+                if context.expired():
+                    raise DeadlineExceeded(f"request expired {time.monotonic() - context.deadline:.3f}s before execution")
+                # 响应服务调用：先经过优先级准入与调度拿到执行名额（流式方法只在创建生成器时占用名额）
+                method = self.services[method_name]
+                queued = time.monotonic()
+                ticket = self.scheduler.acquire(req_data.get('priority'), method_name, context.deadline)
+                started = time.monotonic()
+                stages['queue'] = started - queued
+                try:
+                    with context:
+                        if self.profiler is not None:
+                            res = self.profiler.run(method_name, method, method_args, method_kwargs)
+                        else:
+                            res = method(*method_args, **method_kwargs)
+                finally:
+                    self.scheduler.release(ticket)
+                    stages['execute'] = time.monotonic() - started
+                if inspect.isgenerator(res) and legacy:
+                    res = list(res)  # 旧版客户端不支持流式回复
+                elif inspect.isgenerator(res):
+                    # 流式方法：不在此处序列化整个结果，而是边产出边发送；span 只覆盖到流开始
+                    if trace is not None:
+                        self.record_span(trace, method_name, arrival, arrival_wall, stages, client_addr,
+                                         {'stream': True})
+                    return self.stream_reply(res, client_addr, codec, context)
         except KeyError:
             # 方法名不存在的情况
             res = f"No service found for: {method_name}"
+            error = 'not_found'
         except TypeError as e:
             # 方法参数错误的情况
             res = f"Argument error: {e}"
+            error = 'argument'
+        except DeadlineExceeded as e:
+            # 调用方时间预算已耗尽的情况
+            self.logger.error(f"客户端{str(client_addr)}的请求时间预算已耗尽：{e}")
+            res = f"Deadline exceeded: {e}"
+            error = 'deadline_exceeded'
+        except ServerOverloaded as e:
+            # 服务端饱和，请求被准入控制拒绝的情况
+            self.logger.error(f"拒绝客户端{str(client_addr)}的请求：{e}")
+            res = f"Server overloaded: {e}"
+            error = 'overloaded'
         except Exception as e:
             # 其他调用错误的情况
             res = f"Error calling method: {e}"
+            error = 'internal'
 
-        # 构造响应消息，记录日志并返回序列化后的响应消息
+        # 构造响应消息，记录日志并返回序列化后的响应消息；出错时 error 字段标明错误类别
+        serialize_start = time.monotonic()
         reply_raw = {"res": res}
-        reply = json.dumps(reply_raw).encode('utf-8')
-        self.logger.info(f"给客户端{str(client_addr)}的回复{reply}")
-        return reply
+        if error is not None:
+            reply_raw["error"] = error
+        try:
+            reply = json.dumps(reply_raw).encode('utf-8')
+            frame = reply if legacy else self.pack_reply(reply, codec)
+        except (TypeError, ValueError) as e:
+            # 结果无法 json 序列化（如返回了 bytes），或回复超过单帧上限（FrameTooLarge），改为错误回复，客户端仍能收到回复
+            res = f"Reply too large: {e}" if isinstance(e, FrameTooLarge) else f"Unserializable result: {e}"
+            error = 'internal'
+            reply = json.dumps({"res": res, "error": error}).encode('utf-8')
+            frame = self.pack_reply(reply, codec)
+        if method_name != 'your_ping':  # 与请求日志一致，健康探测不逐条记录
+            self.logger.info(f"给客户端{str(client_addr)}的回复{reply}")
+        if trace is not None:
+            stages['serialize'] = time.monotonic() - serialize_start
+            self.record_span(trace, method_name, arrival, arrival_wall, stages, client_addr,
+                             {'error': error} if error is not None else None)
+        return frame
+
+    def record_span(self, trace, method_name, arrival, arrival_wall, stages, client_addr, tags=None):
+        """记录服务端 span，作为客户端 span 的子 span"""
+        self.tracer.record(trace, method_name, 'SERVER', arrival_wall, time.monotonic() - arrival, stages,
+                           client_addr, tags, span_id=f'{random.getrandbits(64):016x}',
+                           parent_id=trace['span_id'])
+
+    def pack_reply(self, reply, codec):
+        """把序列化后的回复打包成帧，回复不小于压缩阈值时使用协商出的编解码器压缩"""
+        return FrameProtocol.pack(reply, codec, self.compress_threshold or 0, self.compression_metrics)
+
+    def stream_reply(self, gen, client_addr, codec=None, context=None):
+        """
+        把注册方法返回的生成器转换为流式回复帧序列：
+        先发 begin 帧告知流控窗口，之后每产出一项发送一个 data 帧，正常结束发 end 帧，方法中途出错发 error 帧
+        :param gen: 注册方法返回的生成器
+        :param client_addr: 调用方的 ip 地址，运行日志记录需要
+        :param codec: string 与客户端协商出的压缩编解码器，每个帧独立按阈值决定是否压缩
+        :param context: CallContext 调用上下文，生成器在发送过程中才真正执行，执行期间需要重新绑定
+        :return: 逐个产出打包好的回复帧的生成器
+        """
+        count = 0
+        context = context or CallContext(None)
+        try:
+            yield self.pack_reply(json.dumps({"stream": "begin", "window": self.STREAM_WINDOW}).encode('utf-8'), None)
+            try:
+                with context:
+                    for item in gen:
+                        yield self.pack_reply(json.dumps({"stream": "data", "res": item}).encode('utf-8'), codec)
+                        count += 1
+            except Exception as e:
+                self.logger.error(f"给客户端{str(client_addr)}的流式回复在第{count}项后出错：{e}")
+                yield self.pack_reply(
+                    json.dumps({"stream": "error", "res": f"Error calling method: {e}"}).encode('utf-8'), None)
+                return
+            yield self.pack_reply(json.dumps({"stream": "end", "count": count}).encode('utf-8'), None)
+            self.logger.info(f"给客户端{str(client_addr)}的流式回复完成，共{count}项")
+        finally:
+            # 客户端中途放弃时连接处理线程会关闭本生成器，这里同步关闭注册方法的生成器以释放其资源
+            gen.close()
 
 
 class RegistryClient:
     def __init__(self, logger):
         """
         初始化成员信息
-        self.registry_host : string 配置文件中读入的注册中心的 IP
-        self.registry_port : int 配置文件中读入的注册中心的端口号
+        self.registry_endpoints : list 配置文件中读入的注册中心节点 (host, port) 列表，集群模式下有多个
         self.first_register : bool 区分服务端发送的是注册服务请求还是心跳请求
         self.strong_stop_event : threading.Event() RPCServer不再监听/主线程出现问题时被set的event，用于停止给注册中心发心跳的线程，由外界传入此 event
-        self.weak_stop_event : threading.Event() 与注册中心通信出现异常，不该再与注册中心通信是被set的event，用于停止给注册中心发心跳的线程，内部设置
         :param logger: 运行日志
         """
         self.logger = logger
@@ -176,20 +1092,74 @@ class RegistryClient:
         try:
             config.read('docket_test_config.ini')  # docker
             # config.read('../config.ini')  # local
-            registry_host = config['registry']['host']
-            registry_port = int(config['registry']['port'])
+            registry_endpoints = self.parse_registry_endpoints(config['registry'])
         except Exception as e:
             self.logger.error(f"Error occurred in reading registry config:{e}")
             exit(-1)
 
-        self.registry_host = registry_host
-        self.registry_port = registry_port
+        self.registry_endpoints = registry_endpoints
+        self.preferred_index = 0  # 注册与心跳优先发往的节点
+        self.read_index = 0
+        self.endpoint_down_until = {}  # 节点下标 -> 在此时间前视为不可达
         self.first_register = True
+        self.instance_parameters = {'mode': 'development'}  # 加额外控制信息例子
         self.strong_stop_event = None
-        self.weak_stop_event = threading.Event()
-        self.logger.info(f"成功从配置文件读取到注册中心ip地址: {registry_host}:{registry_port}"
+        self.logger.info(f"成功从配置文件读取到注册中心ip地址: "
+                         f"{', '.join(f'{h}:{p}' for h, p in registry_endpoints)}"
                          f"\n=========================================================================================")
 
+    @staticmethod
+    def parse_registry_endpoints(registry_config):
+        """
+        读取注册中心节点列表：集群模式下配置 hosts = host:port,host:port，否则使用单节点的 host 与 port
+        :return: (host, port) 元组 list
+        """
+        if registry_config.get('hosts'):
+            endpoints = []
+            for endpoint in registry_config['hosts'].split(','):
+                endpoint_host, endpoint_port = endpoint.strip().rsplit(':', 1)
+                endpoints.append((endpoint_host.strip('[]'), int(endpoint_port)))
+            return endpoints
+        return [(registry_config['host'], int(registry_config['port']))]
+
+    def request_registry(self, method, url, body=None, headers=None, spread=False):
+        """
+        向注册中心发送 HTTP 请求，失败时依次故障转移到其余节点
+        :param spread: bool 为 True 时每次从下一个节点开始尝试，把读请求分散到各节点；
+                       否则固定从上次成功的节点开始，写请求（注册、心跳）尽量落在同一节点
+        :return: (status, response_body)
+        """
+        count = len(self.registry_endpoints)
+        if spread:
+            self.read_index = (self.read_index + 1) % count
+            start = self.read_index
+        else:
+            start = self.preferred_index
+        # 最近失败过的节点排到最后再试，避免每次都先在不可达节点上等待超时
+        now = time.monotonic()
+        order = sorted(((start + i) % count for i in range(count)),
+                       key=lambda index: self.endpoint_down_until.get(index, 0) > now)
+        last_error = None
+        for index in order:
+            host, port = self.registry_endpoints[index]
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            try:
+                conn.request(method, url, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+                if not spread and index != self.preferred_index:
+                    self.logger.info(f"注册中心故障转移到 {host}:{port}")
+                    self.preferred_index = index
+                self.endpoint_down_until.pop(index, None)
+                return response.status, data
+            except (OSError, http.client.HTTPException) as e:
+                self.logger.error(f"与注册中心 {host}:{port} 通信时发生错误：{e}")
+                self.endpoint_down_until[index] = time.monotonic() + 30
+                last_error = e
+            finally:
+                conn.close()
+        raise last_error
+
     def register_to_registry(self, host, port):
         """
         通过发送HTTP POST请求，向注册中心注册服务，得到注册请求的结果
@@ -197,7 +1167,6 @@ class RegistryClient:
         :param host: 注册服务的IP地址
         :param port: 注册服务的端口
         """
-        conn = http.client.HTTPConnection(self.registry_host, self.registry_port, timeout=10)
         headers = {'Content-type': 'application/json'}
 
         if host == '0.0.0.0':
@@ -205,13 +1174,12 @@ class RegistryClient:
         else:
             instance = InstanceMeta("json", host, port)
 
-        instance.add_parameters({'mode': 'development'})  # 加额外控制信息例子
+        instance.add_parameters(self.instance_parameters)
         instance_data = json.dumps(instance.to_dict())
 
-        conn.request("POST", "/myRegistry/register?proto=json", instance_data, headers)
-        response = conn.getresponse()
-        if response.status == 200:
-            response_data = json.loads(response.read().decode())
+        status, data = self.request_registry("POST", "/myRegistry/register?proto=json", instance_data, headers)
+        if status == 200:
+            response_data = json.loads(data.decode())
             if self.first_register:
                 self.logger.info(f"SUCCESSFULLY REGISTER TO REGISTRY: {response_data}")
                 self.first_register = False
@@ -219,11 +1187,13 @@ class RegistryClient:
                 self.logger.info(f"SEND ❤ TO REGISTRY")
         else:
             if self.first_register:
-                self.logger.error(f"FAIL TO REGISTER TO REGISTRY: {response.read().decode()}")
+                self.logger.error(f"FAIL TO REGISTER TO REGISTRY: {data.decode()}")
             else:
                 self.logger.error(f"FAIL TO SEND ❤ TO REGISTRY")
 
-        conn.close()
+    def add_instance_parameters(self, parameters):
+        """添加注册时附带的服务实例参数，之后每次注册/心跳都会携带"""
+        self.instance_parameters.update(parameters)
 
     def unregister_from_registry(self, host, port):
         """
@@ -231,7 +1201,6 @@ class RegistryClient:
         :param host: 注册服务的IP地址
         :param port: 注册服务的端口
         """
-        conn = http.client.HTTPConnection(self.registry_host, self.registry_port, timeout=10)
         headers = {'Content-type': 'application/json'}
 
         if host == '0.0.0.0':
@@ -241,49 +1210,100 @@ class RegistryClient:
         instance_data = json.dumps(instance.to_dict())
 
         try:
-            conn.request("POST", "/myRegistry/unregister?proto=json", instance_data, headers)
-            response = conn.getresponse()
-            if response.status == 200:
-                response_data = json.loads(response.read().decode())
+            status, data = self.request_registry("POST", "/myRegistry/unregister?proto=json", instance_data, headers)
+            if status == 200:
+                response_data = json.loads(data.decode())
                 self.logger.info(f"SUCCESSFULLY UNREGISTERED TO REGISTRY: \n{response_data}")
             else:
                 self.logger.error(
-                    f"FAIL TO UNREGISTER TO REGISTRY: {response.read().decode()}")
-        except (TimeoutError, ConnectionRefusedError) as e:
-            self.logger.error(f'与注册中心通信时发生错误：{e}，停止与注册中心联系')
-
-        conn.close()
+                    f"FAIL TO UNREGISTER TO REGISTRY: {data.decode()}")
+        except (OSError, http.client.HTTPException) as e:
+            self.logger.error(f'与所有注册中心节点通信均失败：{e}，停止与注册中心联系')
 
     def register_send_heartbeat(self, host, port, stop_e):
+        """
+        定期注册/发送心跳直到 stop_e 被 set；所有注册中心节点都不可达时不放弃，下个周期继续重试，
+        注册中心恢复或集群中有节点恢复后服务端即自动重新注册
+        """
         self.strong_stop_event = stop_e
-        while not self.strong_stop_event.is_set() or not self.weak_stop_event.is_set():
+        while not self.strong_stop_event.is_set():
             try:
                 self.register_to_registry(host, port)
-                time.sleep(5)
             except Exception as e:
-                self.logger.error(f'与注册中心通信时发生错误，停止与注册中心联系：{e}')
-                self.weak_stop_event.set()
+                self.logger.error(f'注册/发送心跳失败，5 秒后重试：{e!r}')
+            self.strong_stop_event.wait(5)
 
 
 class TCPServer:
-    def __init__(self, host, port, logger, stop_event):
+    ACCEPT_POLL_INTERVAL = 0.5  # 监听 socket 的 accept 超时，accept 循环据此定期检查是否停止接受连接
+
+    UNIX_PREFIX = 'unix:'  # host 以此开头表示监听 Unix 域 socket，其后为 socket 文件路径
+
+    def __init__(self, host, port, logger, stop_event, listen_fd=None, unix_path=None, unix_listen_fd=None):
+        """
+        :param host: 监听地址，同时支持 IPv4 和 IPv6；'unix:/path' 表示只监听该路径的 Unix 域 socket
+        :param listen_fd: int 从前任进程继承的监听 socket 文件描述符，不为空时直接在其上接受连接，不再 bind
+        :param unix_path: string 在 TCP 之外同时监听的 Unix 域 socket 路径，供同机客户端绕过回环 TCP 协议栈
+        :param unix_listen_fd: int 从前任进程继承的 Unix 域监听 socket 文件描述符
+        """
         self.port = port
         self.host = host
         self.logger = logger
         self.sock = None
         self.addr_type = None
+        self.unix_path = unix_path
+        self.unix_sock = None
         self.stop_event = stop_event
-        self.set_up_socket()
+        self.accepting = threading.Event()  # 清除后 accept 循环退出并关闭监听 socket，已建立的连接不受影响
+        self.accepting.set()
+        self.set_up_socket(listen_fd)
+        if unix_path is not None:
+            if unix_listen_fd is not None:
+                self.unix_sock = socket.socket(fileno=unix_listen_fd)
+            else:
+                self.unix_sock = self.bind_unix_socket(unix_path)
+            self.unix_sock.settimeout(self.ACCEPT_POLL_INTERVAL)
 
-    def set_up_socket(self):
-        if '.' in self.host:
-            self.addr_type = socket.AF_INET
+    @staticmethod
+    def bind_unix_socket(path):
+        """
+        创建并监听 Unix 域 socket。路径上残留的 socket 文件（上次未正常退出留下）先删除；
+        若该路径上仍有进程在监听则不删除，抛出 OSError
+        """
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f"unix socket {path} is already in use")
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(128)
+        return sock
+
+    def set_up_socket(self, listen_fd=None):
+        if listen_fd is not None:
+            # 不停机重启：继承前任进程的监听 socket，两个进程共享同一个监听队列，交接期间连接不会被拒绝
+            self.sock = socket.socket(fileno=listen_fd)
+            self.addr_type = self.sock.family
+        elif self.host.startswith(self.UNIX_PREFIX):
+            self.addr_type = socket.AF_UNIX
+            self.sock = self.bind_unix_socket(self.host[len(self.UNIX_PREFIX):])
         else:
-            self.addr_type = socket.AF_INET6
-        self.sock = socket.socket(self.addr_type, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
-        self.sock.listen(5)
+            if '.' in self.host:
+                self.addr_type = socket.AF_INET
+            else:
+                self.addr_type = socket.AF_INET6
+            self.sock = socket.socket(self.addr_type, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((self.host, self.port))
+            # 监听队列要足以容纳交接期间（后继进程就绪前后）和突发并发时到达的连接
+            self.sock.listen(128)
+        self.sock.settimeout(self.ACCEPT_POLL_INTERVAL)
 
     def send_tcp_server_stop_signal(self):
         """
@@ -291,14 +1311,16 @@ class TCPServer:
         解决accept不设timeout就无限期阻塞的问题
         """
         # 检查地址类型并设置地址
-        if self.addr_type == socket.AF_INET6:
-            host = '::1'  # IPv6 localhost
+        if self.addr_type == socket.AF_UNIX:
+            address = self.host[len(self.UNIX_PREFIX):]
+        elif self.addr_type == socket.AF_INET6:
+            address = ('::1', self.port)  # IPv6 localhost
         else:
-            host = '127.0.0.1'  # IPv4 localhost
+            address = ('127.0.0.1', self.port)  # IPv4 localhost
 
         h_socket = socket.socket(self.addr_type, socket.SOCK_STREAM)
         try:
-            h_socket.connect((host, self.port))
+            h_socket.connect(address)
             h_socket.close()
             self.logger.info("Successfully sent stop signal to TCP server.")
         except Exception as e:
@@ -313,77 +1335,290 @@ class TCPServer:
         while True:
             time.sleep(0.1)  # 让线程不至于占满CPU
             if self.stop_event.is_set():
-                self.send_tcp_server_stop_signal()
+                # 已经停止接受连接（监听 socket 已关闭或交给了后继进程）时不再自连接，以免连到后继进程上
+                if self.accepting.is_set():
+                    self.send_tcp_server_stop_signal()
                 break
 
     def rpc_client_handler(self, client_sock, client_addr):
         """rpc server处理每个client请求的handler，由继承的RPCServer实现"""
         pass
 
-    def loop_accept_client(self):
-        while not self.stop_event.is_set():
+    def loop_accept_client(self, sock=None):
+        """
+        :param sock: 在其上接受连接的监听 socket，为空则使用 self.sock
+        """
+        sock = sock or self.sock
+        while not self.stop_event.is_set() and self.accepting.is_set():
             try:
-                client_sock, client_addr = self.sock.accept()
-            except socket.timeout as e:
-                if not self.stop_event.is_set():
-                    self.logger.error(f"accept client {e}")
-                continue
+                client_sock, client_addr = sock.accept()
+            except socket.timeout:
+                continue  # accept 超时只是为了定期检查是否停止接受连接
             except socket.error as e:
                 if not self.stop_event.is_set():
                     self.logger.error(f"Error accepting connection: {e}")
                 continue
+            if sock.family == socket.AF_UNIX:
+                client_addr = (f'{self.UNIX_PREFIX}{sock.getsockname()}', 0)  # Unix 域客户端没有地址，以监听路径标识
             if not self.stop_event.is_set():
                 self.logger.info(f'与客户端{str(client_addr)}建立了连接')
             t = threading.Thread(target=self.rpc_client_handler, args=(client_sock, client_addr))
             t.start()
-        self.sock.close()  # 然后关闭自身socket
+        sock.close()  # 然后关闭自身socket（已交给后继进程的监听 socket 在后继进程中仍然打开）
+
+    def unlink_unix_sockets(self):
+        """正常退出（非交接）时删除 Unix 域 socket 文件"""
+        paths = [self.unix_path] if self.unix_path is not None else []
+        if self.host.startswith(self.UNIX_PREFIX):
+            paths.append(self.host[len(self.UNIX_PREFIX):])
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def stop_accepting(self):
+        """停止接受新连接，最多等待一个 accept 超时周期后监听 socket 关闭"""
+        self.accepting.clear()
 
 
 class RPCServer(TCPServer):
-    def __init__(self, host, port):
+    def __init__(self, host, port, compress_threshold=1024, max_concurrency=64, max_queue=256, listen_fd=None,
+                 drain_notice=5, drain_timeout=30, profiling=True, unix_path=None, unix_listen_fd=None):
+        """
+        :param listen_fd: int 不停机重启时从前任进程继承的监听 socket 文件描述符
+        :param drain_notice: float 退出前在注册中心标记为排空中后继续接受连接的时间（秒），应大于客户端轮询注册中心的间隔，
+                             让客户端在本实例停止接受连接前不再选择它
+        :param drain_timeout: float 停止接受连接后等待进行中的请求完成的最长时间（秒），超时强制关闭剩余连接
+        :param profiling: bool 是否提供线上按需剖析的管理方法
+        :param unix_path: string 同时监听的 Unix 域 socket 路径，连同主机名一起注册，同机客户端据此改走 Unix 域 socket
+        :param unix_listen_fd: int 不停机重启时从前任进程继承的 Unix 域监听 socket 文件描述符
+        """
         self.logger = Logger()  # 运行日志创建
-        self.stub = ServerStub(self.logger)
+        scheduler = PriorityScheduler(self.logger, AdaptiveLimiter(max_limit=max_concurrency), max_queue)
+        self.stub = ServerStub(self.logger, compress_threshold, scheduler, Tracer(f'rpc-server-{port}', self.logger),
+                               profiling)
         self.registry_client = RegistryClient(self.logger)
+        self.registry_client.add_instance_parameters(self.stub.compression_parameters())
+        # 声明使用分帧协议，客户端只对声明了的服务端分帧，其余（旧版服务端）按不分帧的 json 格式通信
+        self.registry_client.add_instance_parameters({'framing': True})
+        if unix_path is not None:
+            self.registry_client.add_instance_parameters({'unix_socket': os.path.abspath(unix_path),
+                                                          'hostname': socket.gethostname()})
+        elif host.startswith(TCPServer.UNIX_PREFIX):
+            self.registry_client.add_instance_parameters({'hostname': socket.gethostname()})
+        self.drain_notice = drain_notice
+        self.drain_timeout = drain_timeout
+        self.connections = {}  # 已建立的连接 -> 是否正在处理请求，排空时据此关闭空闲连接、等待忙碌连接
+        self.connections_lock = threading.Lock()
+        self.draining = threading.Event()  # 排空期间每个连接处理完当前请求即关闭
+        self.shutdown_event = threading.Event()  # 收到退出信号（SIGTERM/SIGHUP）时 set，主线程随即开始排空
+        self.handoff_requested = False
         # 线程管理.....
         self.stop_event = threading.Event()
-        super().__init__(host, port, self.logger, self.stop_event)
+        self.heartbeat_stop_event = threading.Event()  # 排空时先于 stop_event 停止心跳
+        super().__init__(host, port, self.logger, self.stop_event, listen_fd, unix_path, unix_listen_fd)
         self.loop_detect_stop_signal_thread = threading.Thread(target=self.loop_detect_stop_signal)
         self.tcp_serve_thread = threading.Thread(target=self.loop_accept_client)
+        self.unix_serve_thread = threading.Thread(target=self.loop_accept_client, args=(self.unix_sock,)) \
+            if self.unix_sock is not None else None
         self.register_and_send_hb_thread = threading.Thread(target=self.registry_client.register_send_heartbeat,
-                                                            args=(self.host, self.port, self.stop_event))
+                                                            args=(self.host, self.port, self.heartbeat_stop_event))
 
     def rpc_client_handler(self, client_sock, client_addr):
+        # 流式回复会连续发送多个小帧，关闭 Nagle 算法避免与客户端延迟确认叠加产生几十毫秒的停顿
+        if client_sock.family != socket.AF_UNIX:
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.connections_lock:
+            self.connections[client_sock] = False
         try:
             while not self.stop_event.is_set():
-                msg = client_sock.recv(1024)
-                if not msg:
-                    raise EOFError()
-                response_data = self.stub.call_method(msg, client_addr)
-                client_sock.sendall(response_data)
+                legacy = FrameProtocol.is_legacy(client_sock)
+                if legacy:
+                    msg = FrameProtocol.recv_legacy(client_sock)
+                else:
+                    msg = FrameProtocol.recv(client_sock, self.stub.compression_metrics)
+                with self.connections_lock:
+                    self.connections[client_sock] = True
+                response_data = self.stub.call_method(msg, client_addr, legacy)
+                if isinstance(response_data, bytes):
+                    client_sock.sendall(response_data)
+                else:
+                    self.send_stream(client_sock, response_data)
+                with self.connections_lock:
+                    self.connections[client_sock] = False
+                if self.draining.is_set():
+                    break  # 排空期间处理完当前请求即关闭连接
         except EOFError:
             self.logger.info(f'info on handle: 客户端{str(client_addr)}关闭了连接')
         except Exception as e:
             self.logger.error(f'except on handle: 客户端{str(client_addr)}异常地关闭了连接, {e}')
         finally:
+            with self.connections_lock:
+                self.connections.pop(client_sock, None)
             client_sock.close()
 
-    def serve(self):
+    def drain_connections(self, timeout):
+        """
+        等待已建立的连接处理完进行中的请求：空闲连接只关闭读方向（recv 随即返回 EOF，处理线程退出），
+        已读到请求的连接仍可写回回复；超时后强制关闭剩余连接
+        :param timeout: float 最长等待时间（秒）
+        :return: bool 是否在超时前全部排空
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.connections_lock:
+                if not self.connections:
+                    return True
+                expired = time.monotonic() >= deadline
+                for client_sock, busy in self.connections.items():
+                    if busy and not expired:
+                        continue
+                    try:
+                        client_sock.shutdown(socket.SHUT_RDWR if expired else socket.SHUT_RD)
+                    except OSError:
+                        pass
+            if expired:
+                self.logger.error(f"Drain timeout after {timeout}s, closed remaining connections")
+                return False
+            time.sleep(0.05)
+
+    def request_shutdown(self, handoff=False):
+        """信号处理函数调用：通知主线程开始排空退出，handoff 为 True 时先把监听 socket 交给后继进程"""
+        self.handoff_requested = handoff
+        self.shutdown_event.set()
+
+    def install_signal_handlers(self):
+        """SIGTERM 排空后退出；SIGHUP 把监听 socket 交给以相同参数启动的新进程后排空退出，用于不停机重启"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.request_shutdown())
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.request_shutdown(handoff=True))
+
+    @staticmethod
+    def successor_argv():
+        """后继进程的命令行：本进程的命令行参数去掉交接用的 --listen-fd / --unix-listen-fd / --ready-fd"""
+        argv = []
+        args = iter(sys.argv)
+        for arg in args:
+            if arg in ('--listen-fd', '--unix-listen-fd', '--ready-fd'):
+                next(args, None)
+            elif not arg.startswith(('--listen-fd=', '--unix-listen-fd=', '--ready-fd=')):
+                argv.append(arg)
+        return argv
+
+    def hand_off(self, ready_timeout=30):
+        """
+        以相同的命令行参数启动后继进程，把监听 socket 的文件描述符传给它；后继进程开始接受连接后通过管道通知本进程。
+        就绪前本进程照常接受连接，之后两个进程短暂共享同一个监听队列，任何时刻都有进程在接受连接
+        :param ready_timeout: float 等待后继进程就绪的最长时间（秒）
+        :return: bool 后继进程是否就绪，未就绪时后继进程被终止，本进程按普通方式排空退出
+        """
+        listen_fd = self.sock.fileno()
+        ready_r, ready_w = os.pipe()
+        argv = [sys.executable] + self.successor_argv() + ['--listen-fd', str(listen_fd), '--ready-fd', str(ready_w)]
+        pass_fds = [listen_fd, ready_w]
+        if self.unix_sock is not None:
+            argv += ['--unix-listen-fd', str(self.unix_sock.fileno())]
+            pass_fds.append(self.unix_sock.fileno())
+        try:
+            successor = subprocess.Popen(argv, pass_fds=pass_fds)
+        except OSError as e:
+            self.logger.error(f"Failed to start successor process: {e}")
+            os.close(ready_r)
+            os.close(ready_w)
+            return False
+        os.close(ready_w)
+        try:
+            readable, _, _ = select.select([ready_r], [], [], ready_timeout)
+            ready = bool(readable) and os.read(ready_r, 1) == b'1'
+        finally:
+            os.close(ready_r)
+        if not ready:
+            self.logger.error(f"Successor process {successor.pid} not ready in {ready_timeout}s, killing it")
+            successor.kill()
+            return False
+        self.logger.info(f"Handed off listening socket to successor process {successor.pid}")
+        return True
+
+    def drain(self, handoff=False):
+        """
+        优雅退出：
+        1. 非交接时先在注册中心标记为排空中（draining），并在通知期内照常接受连接，客户端轮询到后不再选择本实例；
+           交接时实例由后继进程接续，不标记也不注销，只停止本进程的心跳
+        2. 停止接受新连接
+        3. 等待进行中的请求完成（最多 drain_timeout 秒）
+        4. 非交接时从注册中心注销
+        """
+        if not handoff:
+            self.logger.info(f"Draining: marked as draining in registry, still accepting for {self.drain_notice}s")
+            self.registry_client.add_instance_parameters({'draining': True})
+            try:
+                self.registry_client.register_to_registry(self.host, self.port)
+            except Exception as e:
+                self.logger.error(f'标记排空失败：{e}')
+            time.sleep(self.drain_notice)
+        self.heartbeat_stop_event.set()
+        self.stop_accepting()
+        self.tcp_serve_thread.join()
+        if self.unix_serve_thread is not None:
+            self.unix_serve_thread.join()
+        self.draining.set()
+        with self.connections_lock:
+            inflight = len(self.connections)
+        self.logger.info(f"Stopped accepting, waiting for {inflight} connections to finish")
+        if self.drain_connections(self.drain_timeout):
+            self.logger.info("All connections drained")
+        if not handoff:
+            self.unlink_unix_sockets()
+            self.registry_client.unregister_from_registry(self.host, self.port)
+
+    def send_stream(self, client_sock, frames):
+        """
+        发送流式回复，基于信用（credit）做流控：初始信用为一个窗口，每发送一帧消耗一个信用，
+        信用耗尽后阻塞等待客户端消费完一个窗口后回送的 {"credit": n} 帧，避免服务端无限制地领先客户端
+        :param client_sock: 与客户端通信的 socket
+        :param frames: ServerStub.stream_reply 返回的回复帧生成器
+        """
+        try:
+            client_sock.sendall(next(frames))  # begin 帧
+            credits = self.stub.STREAM_WINDOW
+            for frame in frames:
+                if credits == 0:
+                    credits += json.loads(FrameProtocol.recv(client_sock).decode('utf-8'))['credit']
+                client_sock.sendall(frame)
+                credits -= 1
+        finally:
+            frames.close()
+
+    def serve(self, ready_fd=None):
+        """
+        :param ready_fd: int 作为后继进程启动时，开始接受连接后向该管道写入就绪通知
+        """
         self.logger.info(f"From {self.host}:{self.port} start listening...")
+        # 方法都注册完之后再发布方法表，注册中心据此建立方法到服务实例的索引
+        self.registry_client.add_instance_parameters({'methods': self.stub.method_table()})
+        self.install_signal_handlers()
         self.loop_detect_stop_signal_thread.start()
         self.tcp_serve_thread.start()
+        if self.unix_serve_thread is not None:
+            self.unix_serve_thread.start()
         self.register_and_send_hb_thread.start()
+        if ready_fd is not None:
+            os.write(ready_fd, b'1')
+            os.close(ready_fd)
         try:
-            while True:
-                time.sleep(100)
+            while not self.shutdown_event.wait(100):
+                pass
+            self.logger.info(f"Received {'SIGHUP, handing off' if self.handoff_requested else 'SIGTERM'}, stopping...")
         except KeyboardInterrupt:
             self.logger.info("Received KeyboardInterrupt, stopping...")
-            self.registry_client.unregister_from_registry(self.host, self.port)
-            self.stop_event.set()
         except Exception as e:
             self.logger.info(f"Unexpected exception: {e} occurred, stopping...")
-            self.registry_client.unregister_from_registry(self.host, self.port)
-            self.stop_event.set()
+        try:
+            self.drain(handoff=self.handoff_requested and self.hand_off())
         finally:
+            self.stop_event.set()
+            self.stub.tracer.flush()
             self.logger.info("Waiting for other threads to join...")
             self.register_and_send_hb_thread.join(3)
             self.loop_detect_stop_signal_thread.join(3)
@@ -438,18 +1673,57 @@ def hello(name):
     return f"Hello, {name}!"
 
 
+def count_up(n):
+    # 生成器方法会以流式回复返回，客户端得到逐项产出的迭代器
+    for i in range(n):
+        yield i
+
+
+def slow_echo(msg, seconds=1):
+    # 注册方法可以读取调用方剩余的时间预算，预算不够时直接放弃，不做没人等待的工作
+    remaining = CallContext.remaining()
+    if remaining is not None and remaining < seconds:
+        raise DeadlineExceeded(f"needs {seconds}s but only {remaining:.3f}s left")
+    time.sleep(seconds)
+    return msg
+
+
 if __name__ == '__main__':
     pars = argparse.ArgumentParser(description='RPC Server based on TCP + JSON')
 
     pars.add_argument('-l', '--host', type=str, default='0.0.0.0',
-                      help='服务端监听的 ip 地址，同时支持 IPv4 和 IPv6，可以为空，默认监听所有 ip 地址')
+                      help='服务端监听的 ip 地址，同时支持 IPv4 和 IPv6，可以为空，默认监听所有 ip 地址；'
+                           'unix:/path 表示只监听该路径的 Unix 域 socket（只有同机客户端可以调用）')
     pars.add_argument('-p', '--port', type=int, required=True,
                       help='服务端监听的端口号，不可为空')
+    pars.add_argument('--compress-threshold', type=int, default=1024,
+                      help='请求/回复帧压缩阈值（字节），不小于该大小的帧在双方都支持时压缩，默认 1024')
+    pars.add_argument('--no-compression', action='store_true',
+                      help='关闭帧压缩，不向注册中心声明压缩能力')
+    pars.add_argument('--max-concurrency', type=int, default=64,
+                      help='同时执行的请求数上限，实际上限在此范围内根据执行耗时自适应调整，默认 64')
+    pars.add_argument('--max-queue', type=int, default=256,
+                      help='饱和时排队等待执行的请求数上限，超出后优先丢弃低优先级请求，默认 256')
+    pars.add_argument('--drain-notice', type=float, default=5,
+                      help='退出前在注册中心标记为排空中后继续接受连接的秒数，应大于客户端轮询注册中心的间隔，默认 5')
+    pars.add_argument('--drain-timeout', type=float, default=30,
+                      help='停止接受连接后等待进行中的请求完成的最长秒数，默认 30')
+    pars.add_argument('--no-profiling', action='store_true',
+                      help='关闭 your_profile_start / your_profile_stop 管理方法')
+    pars.add_argument('--unix-socket', type=str,
+                      help='同时监听的 Unix 域 socket 路径，同一台机器上的客户端会优先通过它调用')
+    pars.add_argument('--listen-fd', type=int, help='不停机重启时由前任进程传入的监听 socket 文件描述符，无需手动指定')
+    pars.add_argument('--unix-listen-fd', type=int, help='不停机重启时由前任进程传入的 Unix 域监听 socket，无需手动指定')
+    pars.add_argument('--ready-fd', type=int, help='不停机重启时由前任进程传入的就绪通知管道，无需手动指定')
 
     args = pars.parse_args()
 
-    server = RPCServer(args.host, args.port)
-    server.stub.register_services(add)
-    server.stub.register_services(hi)
-    server.stub.register_services(area_of_circle)
-    server.serve()
+    server = RPCServer(args.host, args.port, None if args.no_compression else args.compress_threshold,
+                       args.max_concurrency, args.max_queue, args.listen_fd, args.drain_notice, args.drain_timeout,
+                       not args.no_profiling, args.unix_socket, args.unix_listen_fd)
+    server.stub.register_services(add, idempotent=True)
+    server.stub.register_services(hi, idempotent=True)
+    server.stub.register_services(area_of_circle, idempotent=True)
+    server.stub.register_services(count_up)
+    server.stub.register_services(slow_echo, idempotent=True)
+    server.serve(args.ready_fd)
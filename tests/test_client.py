@@ -0,0 +1,112 @@
+import os
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'client'))
+
+import pytest  # noqa: E402
+
+from client import RPCClient, StubGenerator  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    """直连一个没有服务端监听的端口：每次调用都很快以 unavailable 失败，不需要真实的服务端"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = RPCClient(host='127.0.0.1', port=port, timeout=1, probe_interval=None)
+    client.tracer.sample_rate = 0
+    yield client
+    client.stop()
+
+
+def consume(iterator, timeout=10):
+    """在另一个线程中迭代，超时仍未结束视为挂起；返回 (已产出的各项, 抛出的异常)"""
+    outcome = {'items': [], 'error': None}
+
+    def run():
+        try:
+            for item in iterator:
+                outcome['items'].append(item)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'iteration hung'
+    return outcome['items'], outcome['error']
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_map_reraises_input_iterator_error(client, ordered):
+    def arguments():
+        yield from range(3)
+        raise ValueError('bad input')
+
+    results, error = consume(client.map('hi', arguments(), concurrency=2, ordered=ordered))
+    assert isinstance(error, ValueError) and str(error) == 'bad input'
+    assert sorted(result['index'] for result in results) == [0, 1, 2]
+    assert all(result['error'] == 'unavailable' for result in results)
+
+
+def test_map_without_input_error_yields_every_item(client):
+    results, error = consume(client.map('hi', range(5), concurrency=2))
+    assert error is None
+    assert [result['index'] for result in results] == [0, 1, 2, 3, 4]
+
+
+class RecordingClient:
+    """只记录桩发出的调用，不连接服务端"""
+
+    def __init__(self):
+        self.calls = []
+
+    def invoke(self, method, args, kwargs, options):
+        self.calls.append((method, args, kwargs))
+
+    @staticmethod
+    def envelope_prefix(method):
+        return b''
+
+
+def make_stub(methods):
+    namespace = {}
+    exec(StubGenerator.generate(methods), namespace)
+    client = RecordingClient()
+    return namespace['RPCStub'](client), client.calls
+
+
+def test_stub_forwards_only_arguments_the_caller_passed():
+    stub, calls = make_stub([
+        {'method_name': 'add', 'params': [{'name': 'a', 'kind': 'POSITIONAL_OR_KEYWORD'},
+                                          {'name': 'b', 'kind': 'POSITIONAL_OR_KEYWORD'},
+                                          {'name': 'c', 'kind': 'POSITIONAL_OR_KEYWORD', 'has_default': True,
+                                           'default': 10}]},
+        # 无法 json 序列化的默认值服务端只标记 has_default
+        {'method_name': 'split', 'params': [{'name': 'data', 'kind': 'POSITIONAL_OR_KEYWORD'},
+                                            {'name': 'sep', 'kind': 'POSITIONAL_OR_KEYWORD', 'has_default': True},
+                                            {'name': 'limit', 'kind': 'KEYWORD_ONLY', 'has_default': True,
+                                             'default': -1}]},
+    ])
+    stub.add(1, 2)
+    stub.add(1, 2, 3)
+    stub.split('a,b')
+    stub.split('a,b', limit=1)
+    assert calls == [('add', (1, 2), {}), ('add', (1, 2, 3), {}), ('split', ('a,b',), {}),
+                     ('split', ('a,b',), {'limit': 1})]
+    with pytest.raises(TypeError):
+        stub.add(1)
+
+
+def test_stub_sends_positionals_after_a_skipped_one_by_keyword():
+    stub, calls = make_stub([
+        {'method_name': 'f', 'params': [{'name': name, 'kind': 'POSITIONAL_OR_KEYWORD', 'has_default': True}
+                                        for name in ('a', 'b', 'c')]},
+    ])
+    stub.f(c=3)
+    stub.f(1, c=3)
+    assert calls == [('f', (), {'c': 3}), ('f', (1,), {'c': 3})]
@@ -0,0 +1,124 @@
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+import pytest  # noqa: E402
+
+import server  # noqa: E402
+from server import AdaptiveLimiter, FrameProtocol, InstanceMeta, Logger, RequestProfiler, ServerStub  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """虚拟时钟：模拟中按请求耗时推进，上限减小的间隔判断不依赖真实时间"""
+    now = [0.0]
+    monkeypatch.setattr(server.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def simulate(limiter, clock, samples, offered, capacity, base=0.01, sigma=0.5, seed=1):
+    """
+    模拟容量为 capacity 的服务端：并发数不超过容量时耗时为 base（带对数正态抖动），超过后耗时与并发数成正比
+    :param offered: int 客户端同时发来的请求数，实际并发为它与当前上限中的较小者
+    :return: list 每个样本之后的并发上限
+    """
+    rng = random.Random(seed)
+    history = []
+    for _ in range(samples):
+        inflight = min(limiter.current(), offered)
+        latency = base * math.exp(rng.gauss(0, sigma)) * max(1.0, inflight / capacity)
+        clock[0] += latency / inflight
+        limiter.on_sample('m', latency, inflight)
+        history.append(limiter.current())
+    return history
+
+
+@pytest.mark.parametrize('idle', [50, 20000])
+@pytest.mark.parametrize('sigma', [0.0, 0.5])
+def test_limit_backs_off_to_capacity_under_sustained_overload(clock, idle, sigma):
+    limiter = AdaptiveLimiter(max_limit=64)
+    simulate(limiter, clock, idle, offered=4, capacity=8, sigma=sigma)
+    history = simulate(limiter, clock, 30000, offered=200, capacity=8, sigma=sigma)
+    # 基线来自不拥挤时的样本，上限稳定在耗时升到 tolerance 倍处，即约 1.5 倍容量，且不随过载持续而上涨
+    assert max(history[-10000:]) <= 2 * 8
+    assert sum(history[-10000:]) / 10000 <= 1.75 * 8
+
+
+def test_limit_stays_bounded_when_saturated_from_start(clock):
+    limiter = AdaptiveLimiter(max_limit=64)
+    history = simulate(limiter, clock, 30000, offered=200, capacity=8)
+    # 没有不拥挤样本时以热身期间（初始上限 16 下）的平均耗时为基线，上限约为其 tolerance 倍，不会涨到 max_limit
+    assert max(history[-10000:]) <= 4 * 8
+
+
+def test_limit_recovers_when_method_itself_slows_down(clock):
+    limiter = AdaptiveLimiter(max_limit=64)
+    simulate(limiter, clock, 5000, offered=4, capacity=8)
+    simulate(limiter, clock, 5000, offered=200, capacity=8)
+    history = simulate(limiter, clock, 30000, offered=200, capacity=8, base=0.03)
+    # 上限先减到 min_limit，此时的样本重新校准基线，之后回到容量附近
+    assert sum(history[-10000:]) / 10000 >= 8
+
+
+def test_noise_without_overload_does_not_lower_limit(clock):
+    limiter = AdaptiveLimiter()
+    history = simulate(limiter, clock, 30000, offered=12, capacity=1000, sigma=1.0)
+    assert min(history) >= 12
+
+
+def split(data, sep=b','):
+    return data.split(sep)
+
+
+def encode(text):
+    return text.encode('utf-8')
+
+
+def call(stub, method_name, *args):
+    """经 call_method 调用一次并解析回复帧"""
+    req = json.dumps({'method_name': method_name, 'method_args': list(args), 'method_kwargs': {}}).encode('utf-8')
+    frame = stub.call_method(req, ('127.0.0.1', 0))
+    return json.loads(frame[FrameProtocol.HEADER.size:].decode('utf-8'))
+
+
+def test_method_with_bytes_default_can_be_registered():
+    stub = ServerStub(Logger(), profiling=False)
+    stub.register_services(split)
+    table = stub.method_table()
+    # 注册/心跳的请求体必须能序列化，否则服务端永远注册不上
+    instance = InstanceMeta('json', '127.0.0.1', 12345)
+    instance.add_parameters({'methods': table})
+    json.dumps(instance.to_dict())
+    assert table[0]['params'][1] == {'name': 'sep', 'kind': 'POSITIONAL_OR_KEYWORD', 'has_default': True}
+    assert table[0]['method_kwargs'] == {'sep': None}
+
+
+def test_all_your_methods_replies_with_bytes_default():
+    stub = ServerStub(Logger(), profiling=False)
+    stub.register_services(split)
+    reply = call(stub, 'all_your_methods')
+    assert 'error' not in reply
+    assert [method['method_name'] for method in reply['res']] == ['split']
+
+
+def test_unserializable_result_gets_error_reply():
+    stub = ServerStub(Logger(), profiling=False)
+    stub.register_services(encode)
+    reply = call(stub, 'encode', 'a')
+    assert reply['error'] == 'internal'
+    assert reply['res'].startswith('Unserializable result')
+
+
+def test_cprofile_falls_back_to_sampling_without_per_request_profiling(monkeypatch):
+    monkeypatch.setattr(RequestProfiler, 'PER_REQUEST_CPROFILE', False)
+    profiler = RequestProfiler(Logger(), {'split': split})
+    status = profiler.start('cprofile', seconds=5)
+    assert status['mode'] == 'sampling' and 'note' in status
+    assert profiler.run('split', split, (b'a,b',), {}) == [b'a', b'b']
+    report = profiler.stop()
+    assert report['mode'] == 'sampling' and report['note'] == status['note']
+    assert report['methods']['split']['calls'] == 1